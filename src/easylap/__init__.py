@@ -1,5 +1,24 @@
-from .aiodevice import AioEasyLapDevice
-from .device import EasyLapDevice, EasyLapDeviceException
-from .unicast_client import UnicastClient
-from .unicast_server import UnicastServer
-from .service import CreateService
\ No newline at end of file
+# The classes below are imported from their modules when first used, so that importing
+# one module of the package (e.g. easylap.decoder) does not import all the others.
+
+EXPORTS = {
+  'AioEasyLapDevice': 'aiodevice',
+  'FrameDecoder': 'decoder',
+  'EasyLapDevice': 'device',
+  'EasyLapDeviceException': 'device',
+  'UnicastClient': 'unicast_client',
+  'UnicastServer': 'unicast_server',
+  'CreateService': 'service',
+}
+
+__all__ = list(EXPORTS)
+
+
+def __getattr__(name):
+  module = EXPORTS.get(name)
+  if module is None:
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+  from importlib import import_module
+  value = getattr(import_module('.' + module, __name__), name)
+  globals()[name] = value
+  return value
@@ -0,0 +1,106 @@
+# Reads several EasyLap devices at once and merges their packets into one stream.
+#
+# Larger tracks have a receiver at start/finish and more at sector splits. Each device has
+# its own reader, DeviceSupervisor and ClockSync: the device timers are not synchronized, so
+# packets are ordered by the host time of the crossing, as estimated by the clock model of
+# the device that saw it (the time the packet was read, until the model is ready).
+#
+# Packets wait in a heap for a short reordering window after their crossing time. A device
+# that is slow or gone holds back the others by at most that window. A packet that arrives
+# after a later crossing was already released is sent anyway and counted as late.
+
+import asyncio
+import heapq
+import time
+
+from .base import Base, LogOptions
+from .clock import ClockSync
+from .supervisor import DeviceSupervisor
+
+
+class DeviceAggregator(Base):
+  """ Merges the packets of several devices, tagged with the device name """
+
+  WINDOW = 0.05 # Seconds a packet waits for crossings seen by the other devices
+  KEY_DEVICE = 'device'
+
+  def __init__(self, devices, window = WINDOW, on_state = None, log_options = LogOptions(), ticks_per_second = ClockSync.TICKS_PER_SECOND):
+    """
+    :param devices: AioEasyLapDevice objects with distinct names, opened or not
+    :param window: the reordering window, seconds
+    :param on_state: callback that receives (device name, DeviceSupervisor.CONNECTED or DISCONNECTED)
+    :param log_options: the log options
+    :param ticks_per_second: device timer ticks per second
+    """
+    super().__init__('DeviceAggregator', log_options)
+    self.devices = {device.name: device for device in devices}
+    if len(self.devices) != len(devices):
+      raise ValueError('Device names must be distinct')
+    self.clocks = {name: ClockSync(ticks_per_second = ticks_per_second) for name in self.devices}
+    self.supervisors = {name: DeviceSupervisor(device, lambda state, name = name: self.set_state(name, state), log_options)
+      for name, device in self.devices.items()}
+    self.window = window
+    self.on_state = on_state
+    self.heap = [] # (crossing time, arrival order, device name, packet, time read)
+    self.count = 0 # Packets received, keeps the heap order stable
+    self.wakeup = None
+    self.released = None # Crossing time of the last packet released
+    self.late = 0 # Packets released after a later crossing
+
+
+  def set_state(self, name, state):
+    if state == DeviceSupervisor.CONNECTED:
+      self.clocks[name].reset() # The device may have been power cycled
+    if self.on_state:
+      self.on_state(name, state)
+
+
+  async def read(self, device):
+    """ Reads one device into the heap, until it fails """
+    name = device.name
+    clock = self.clocks[name]
+    heap = self.heap
+    async for packet in device.receive():
+      received_at = packet.received_at
+      timer_value = packet.time
+      if not packet.uid: # Timer packet
+        clock.add(timer_value, received_at)
+      when = clock.host_time(timer_value)
+      if when is None or when > received_at: # Not before the model is ready, never in the future
+        when = received_at
+      packet[self.KEY_DEVICE] = name
+      heapq.heappush(heap, (when, self.count, name, packet, received_at))
+      self.count += 1
+      self.wakeup.set()
+
+
+  async def receive(self):
+    """ Async generator of (device name, packet, crossing time, time read), in crossing time order """
+    self.wakeup = asyncio.Event()
+    tasks = [asyncio.ensure_future(supervisor.run(self.read)) for supervisor in self.supervisors.values()]
+    heap = self.heap
+    try:
+      while True:
+        if not heap:
+          self.wakeup.clear()
+          await self.wakeup.wait()
+          continue
+        when = heap[0][0]
+        delay = when + self.window - time.monotonic()
+        if delay > 0: # Wait for the window to close, or for an earlier crossing
+          self.wakeup.clear()
+          try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+          except asyncio.TimeoutError:
+            pass
+          continue
+        when, count, name, packet, received_at = heapq.heappop(heap)
+        if self.released is not None and when < self.released:
+          self.late += 1
+        else:
+          self.released = when
+        yield name, packet, when, received_at
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,84 +1,222 @@
 # Asynchronous reading from a EasyLap device.
+#
+# By default the blocking CP2110 reads run in a dedicated reader thread. Decoded frames
+# are handed to the event loop through a bounded queue (see the pipeline module: timer
+# frames are dropped first, car frames never), so the loop sleeps while the device is
+# idle. The older mode that polls the device on the event loop is still available with
+# threaded=False.
+#
+# The object can outlive the USB connection: close() and open() reopen only the HID
+# device, the logger, the decoder counters and the UART configuration are kept. See the
+# supervisor module. The reader thread is not joined, a read in progress would block the
+# event loop; closing the HID device under that read would free it in use, so while the
+# thread is still reading, close() leaves the device to the thread, which closes it on exit.
+#
+# Several devices can be used at the same time (see the aggregator module): enumerate()
+# lists them, serial or path selects one.
  
 import asyncio
-import sys
+import threading
+import time
 from concurrent.futures._base import CancelledError
 
+from . import backend
 from .base import Base, LogOptions
+from .decoder import FrameDecoder
 from .device import EasyLapDeviceException
-try:
-  from cp2110 import CP2110Device, UARTConfig, PARITY, FLOW_CONTROL, DATA_BITS, STOP_BITS, RX_TX_MAX
-except ImportError:
-  try:
-    from .fake.cp2110 import *
-  except ImportError as e:
-    print('Cannot import: {} - exiting.'.format(e))
-    sys.exit(1)
+from .frame import Frame
+from .pipeline import BoundedQueue, is_timer_frame
 
   
 class AioEasyLapDevice(Base):
   """ Asynchronous EasyLap device """
   
+  EASYLAP_VID = 0x10C4 # Silicon Labs
   EASYLAP_PID = 0x86B9
   KEY_TIME = "time"
   KEY_UID = "uid"
+  QUEUE_SIZE = BoundedQueue.CAPACITY # Frames waiting for the event loop
+  POLL_INTERVAL = 0.005 # Seconds to wait when the device has no data
   
-  def __init__(self, log_options = LogOptions()):
-    """ Init, can throw exception """
-    super().__init__('AioEasyLapDevice', log_options)
+  uart_config = None # Created once, see configure()
+  
+  def __init__(self, log_options = LogOptions(), threaded = True, queue_size = QUEUE_SIZE, connect = True, serial = None, path = None, name = None):
+    """ Init, can throw exception
     
+    :param log_options: the log options
+    :param threaded: read the device in a reader thread instead of polling it on the event loop
+    :param queue_size: the maximum number of frames waiting for the event loop
+    :param connect: open the device now, False leaves it to open()
+    :param serial: the serial number of the device to open, None for any
+    :param path: the HID path of the device to open, None for any
+    :param name: the name of the device in packets and logs, defaults to the serial number or path
+    """
+    super().__init__('AioEasyLapDevice', log_options)
+    self.threaded = threaded
+    self.queue_size = queue_size
+    self.serial = serial
+    self.path = path
+    self.name = name or serial or (path.decode() if isinstance(path, bytes) else path)
+    self.received_at = None # time.monotonic() when the last yielded frame was read
+    self.decoder = FrameDecoder()
+    self.queue = BoundedQueue('device {}'.format(self.name or '').strip(), queue_size, is_timer_frame) # From the reader thread
+    self.device = None
+    self.lock = threading.Lock()
+    self.reader = None # {'stop', 'done', 'close'} of the reader thread of the last connection
+    if connect:
+      self.open()
+  
+  
+  @property
+  def dropped(self):
+    """ Frames dropped because the queue was full """
+    return self.queue.dropped
+  
+  
+  @classmethod
+  def configure(cls):
+    """ Returns the UART configuration """
+    if cls.uart_config is None:
+      cp2110 = backend.cp2110()
+      cls.uart_config = cp2110.UARTConfig(
+        baud=38400, parity=cp2110.PARITY.NONE, flow_control=cp2110.FLOW_CONTROL.DISABLED,
+        data_bits=cp2110.DATA_BITS.EIGHT, stop_bits=cp2110.STOP_BITS.SHORT)
+    return cls.uart_config
+  
+  
+  @classmethod
+  def enumerate(cls):
+    """ Returns [{'serial': serial number, 'path': HID path}] for each connected EasyLap device """
+    enumerate_devices = getattr(backend.cp2110(), 'enumerate', None)
+    if enumerate_devices is None: # Older cp2110 versions
+      import hid
+      enumerate_devices = hid.enumerate
+    return [{'serial': info.get('serial_number') or None, 'path': info.get('path')}
+      for info in enumerate_devices(cls.EASYLAP_VID, cls.EASYLAP_PID)]
+  
+  
+  def open(self):
+    """ Opens the device, can throw EasyLapDeviceException """
+    self.close()
+    self.decoder.reset() # A partial frame from the previous connection
     try:
-      self.device = CP2110Device(pid=self.EASYLAP_PID)
-    
-      self.device.set_uart_config(UARTConfig(
-        baud=38400, parity=PARITY.NONE, flow_control=FLOW_CONTROL.DISABLED,
-        data_bits=DATA_BITS.EIGHT, stop_bits=STOP_BITS.SHORT))
-      self.device.enable_uart()
+      device = backend.cp2110().CP2110Device(pid=self.EASYLAP_PID, serial=self.serial, path=self.path)
+      device.set_uart_config(self.configure())
+      device.enable_uart()
     except Exception as e:
       raise EasyLapDeviceException(e)
+    self.device = device
+  
+  
+  def close(self):
+    """ Closes the device, if open, or has the reader thread close it when it leaves read() """
+    device, self.device = self.device, None
+    if device is None:
+      return
+    with self.lock:
+      reader = self.reader
+      if reader is not None and not reader['done']:
+        reader['stop'].set()
+        reader['close'] = device
+        return
+    self.close_device(device)
+
+
+  def close_device(self, device):
+    close = getattr(device, 'close', None)
+    if close:
+      try:
+        close()
+      except Exception as e:
+        self.debug('Cannot close device: %s', e)
   
   
   async def receive(self):
-    """ Async generator """
+    """ Async generator of Frame objects """
+    frames = self.read_threaded() if self.threaded else self.read_polling()
     try:
-      d = self.device
-      buf = []
-      
-      while True:
-        chunk = d.read(RX_TX_MAX + 1)
-        while chunk:
-          buf += chunk
-          await asyncio.sleep(0)
-          chunk = d.read(RX_TX_MAX + 1)
-      
-        if not buf:
-          await asyncio.sleep(0)
-          continue
-        
-        if buf[0] == 0x0B: # Timer packet
-          if len(buf) >= 3 and buf[2] != 0x83: # garbage? discard one
-            buf = buf[1:]
-          elif len(buf) >= 0x0B: # 11 bytes
-            timer_value = (buf[3] | buf[4] << 8 | buf[5] << 16 | buf[6] << 32)
-            # print("timer: %s" % timer_value)
-            # yield({'t': timer_value, 'c': 0})
-            yield({self.KEY_TIME: timer_value, self.KEY_UID: 0})
-            buf = buf[0x0B + 1:]
-             
-        elif buf[0] == 0x0D: # Car packet
-          if len(buf) >= 3 and buf[2] != 0x84: # garbage? discard one
-            buf = buf[1:]
-          elif len(buf) >= 0x0D: # 13 bytes
-            uid = (buf[3] | buf[4] << 8)
-            timer_value = (buf[7] | buf[8] << 8 | buf[9] << 16 | buf[10] << 32)
-            # print("car: %s: %s" % (uid, timer_value))
-            yield({self.KEY_TIME: timer_value, self.KEY_UID:uid})
-            buf = buf[0x0D + 1:]
-        
-        else:  
-          buf = buf[1:]
-          
+      async for frame in frames:
+        yield frame
+
     except CancelledError as e:
       raise e
     except Exception as e:
       raise EasyLapDeviceException(e)
+    finally:
+      await frames.aclose() # Stops the reader thread
+  
+  
+  async def read_polling(self):
+    """ Async generator of frames, reads the device on the event loop """
+    d = self.device
+    decoder = self.decoder
+    size = backend.cp2110().RX_TX_MAX + 1
+    
+    while True:
+      chunk = d.read(size)
+      while chunk:
+        received_at = self.received_at = time.monotonic()
+        for frame_type, uid, timer_value in decoder.feed(chunk):
+          yield Frame(frame_type, uid, timer_value, received_at)
+        await asyncio.sleep(0)
+        chunk = d.read(size)
+      await asyncio.sleep(self.POLL_INTERVAL)
+  
+  
+  async def read_threaded(self):
+    """ Async generator of frames, reads the device in a reader thread """
+    loop = asyncio.get_running_loop()
+    queue = self.queue
+    queue.clear() # Left from a previous connection
+    stop = threading.Event()
+    failure = []
+    state = self.reader = {'stop': stop, 'done': False, 'close': None}
+    
+    def put(frames):
+      """ Called on the event loop """
+      if stop.is_set(): # Read just before this connection ended, the queue may belong to the next one
+        return
+      for frame in frames:
+        queue.put(frame)
+    
+    def fail(e):
+      """ Called on the event loop. The reader has stopped, the wake-up is never dropped. """
+      failure.append(e)
+      queue.put(None)
+    
+    size = backend.cp2110().RX_TX_MAX + 1
+    
+    def reader():
+      d = self.device
+      decoder = self.decoder
+      try:
+        while not stop.is_set():
+          chunk = d.read(size)
+          if not chunk:
+            stop.wait(self.POLL_INTERVAL)
+            continue
+          received_at = time.monotonic()
+          frames = [Frame(frame_type, uid, timer_value, received_at) for frame_type, uid, timer_value in decoder.feed(chunk)]
+          if frames: # One wake-up per chunk, not per frame
+            loop.call_soon_threadsafe(put, frames)
+      except Exception as e:
+        if not stop.is_set():
+          loop.call_soon_threadsafe(fail, e)
+      finally:
+        with self.lock:
+          state['done'] = True
+          device = state['close']
+        if device is not None: # close() was called during a read
+          self.close_device(device)
+    
+    thread = threading.Thread(target=reader, name='AioEasyLapDevice reader', daemon=True)
+    thread.start()
+    try:
+      while True:
+        frame = await queue.get()
+        if frame is None:
+          raise failure[0]
+        self.received_at = frame.received_at
+        yield frame
+    finally:
+      stop.set() # Do not join: a read in progress would block the event loop
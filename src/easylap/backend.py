@@ -0,0 +1,51 @@
+# Optional hardware libraries, imported when first used.
+#
+# The cp2110 library (with the HID library under it) and the Adafruit libraries for the
+# lights are slow to import on a Raspberry Pi Zero and are missing on a development
+# machine. Nothing imports them when the easylap package is imported; they are imported
+# the first time a device or the lights are opened. Where a library is missing, the fake
+# in easylap.fake is used instead. Set cp2110_module (or mcp23017_modules) beforehand to
+# force a backend, e.g. the fake one in a benchmark.
+
+import time
+
+cp2110_module = None
+mcp23017_modules = None # (board, busio, MCP23017)
+timings = {} # Backend name: seconds spent importing it
+
+
+def cp2110():
+  """ Returns the cp2110 module, or the fake one """
+  global cp2110_module
+  if cp2110_module is None:
+    started = time.perf_counter()
+    try:
+      import cp2110 as module
+      module.CP2110Device # A package of the same name without the library
+    except (ImportError, AttributeError):
+      from .fake import cp2110 as module
+    cp2110_module = module
+    timings['cp2110'] = time.perf_counter() - started
+  return cp2110_module
+
+
+def mcp23017():
+  """ Returns (board, busio, MCP23017), the real ones on a Raspberry Pi, otherwise the fakes """
+  global mcp23017_modules
+  if mcp23017_modules is None:
+    started = time.perf_counter()
+    try:
+      # These are available only on Raspberry Pi
+      import board
+      import busio
+      from adafruit_mcp230xx.mcp23017 import MCP23017
+    except Exception: # board raises NotImplementedError on an unknown board
+      from .fake import board, busio
+      from .fake.mcp23017 import MCP23017
+    mcp23017_modules = (board, busio, MCP23017)
+    timings['mcp23017'] = time.perf_counter() - started
+  return mcp23017_modules
+
+
+def is_fake(module):
+  return module.__name__.startswith('easylap.fake')
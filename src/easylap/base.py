@@ -1,50 +1,80 @@
+import atexit
 import logging
+import queue
 import sys
 from os import path
-from logging.handlers import SysLogHandler
+from logging.handlers import QueueHandler, QueueListener, SysLogHandler
+
+# Handlers are created once per logger name, so objects that are created again and again
+# (e.g. AioEasyLapDevice after a reconnect) do not stack handlers. Syslog records go
+# through a queue to a listener thread: a stalled /dev/log never blocks the event loop.
+# Pass arguments to the log methods instead of formatting the message: the message is
+# formatted only if the record is emitted.
 
 class LogOptions:
   def __init__(self, log_level = logging.INFO, syslog = False, stdout = True):
     self.log_level = log_level
     self.syslog = syslog
     self.stdout = stdout
-    
+
 class Base:
- 
-  
+
+  loggers = {} # Logger name: the LogOptions its handlers were created with
+  syslog_queue = None # Shared by all loggers that use syslog
+  syslog_listener = None
+
   def __init__(self, name, log_options = LogOptions()):
+    self.log_options = log_options
+    self.logger = self.get_logger(name, log_options)
+
+
+  @classmethod
+  def get_logger(cls, name, log_options):
+    """ Returns the named logger, adds handlers only the first time """
     logger = logging.getLogger(name)
     logger.setLevel(log_options.log_level)
-    handler = None
+    if name in cls.loggers:
+      return logger
+    cls.loggers[name] = log_options
+
     if log_options.syslog:
+      logger.addHandler(QueueHandler(cls.get_syslog_queue()))
+
+    if log_options.stdout:
+      handler = logging.StreamHandler(sys.stdout)
+      handler.setFormatter(logging.Formatter('%(message)s'))
+      logger.addHandler(handler)
+    return logger
+
+
+  @classmethod
+  def get_syslog_queue(cls):
+    """ Starts the syslog listener thread the first time """
+    if cls.syslog_queue is None:
       formatter = logging.Formatter('%(asctime)s %(message)s')
       if path.exists('/dev/log'):
         handler = SysLogHandler(address = '/dev/log')
       else:
         handler = logging.StreamHandler(sys.stderr)
       handler.setFormatter(formatter)
-      logger.addHandler(handler)
-      
-    if log_options.stdout:
-      handler = logging.StreamHandler(sys.stdout)
-      handler.setFormatter(logging.Formatter('%(message)s'))
-      logger.addHandler(handler)
- 
-    self.log_options = log_options     
-    self.logger = logger
-    
-    
-  def log(self, level, msg):
-    self.logger.log(level, msg)
-   
-    
-  def info(self, msg):
-    self.logger.info(msg)
-   
-    
-  def debug(self, msg):
-    self.logger.debug(msg)
-   
-    
-  def error(self, msg):
-    self.logger.error(msg)
\ No newline at end of file
+      cls.syslog_queue = queue.SimpleQueue()
+      cls.syslog_listener = QueueListener(cls.syslog_queue, handler)
+      cls.syslog_listener.start()
+      atexit.register(cls.syslog_listener.stop) # Writes what is queued
+    return cls.syslog_queue
+
+
+  def log(self, level, msg, *args):
+    self.logger.log(level, msg, *args)
+
+
+  def info(self, msg, *args):
+    self.logger.info(msg, *args)
+
+
+  def debug(self, msg, *args):
+    self.logger.debug(msg, *args)
+
+
+  def error(self, msg, *args):
+    self.logger.error(msg, *args)
@@ -0,0 +1,195 @@
+# Registry of the clients of UnicastServer.
+#
+# Client records are kept in an OrderedDict in the order they were last seen, so the
+# least recently seen client is always first. Expiry pops from the front until it finds a
+# client that is still alive, and a single timer is scheduled for the deadline of the new
+# first client: nothing scans or copies the registry. The same order picks the client to
+# evict when the registry is full. One host gets at most MAX_PER_HOST registrations, so an
+# app that sends HELLO from random ports only evicts its own registrations.
+#
+# A phone that leaves the Wi-Fi stops answering long before it expires. The server
+# reports every datagram that could not be delivered to a client (see
+# UnicastServer.error_received); after MAX_FAILURES of them without a HELLO in between the
+# client is removed at once.
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from .wire import Encoding
+
+
+class Client:
+  """ A registered client """
+
+  __slots__ = ('addr', 'seen', 'registered', 'encoding', 'options', 'subscription', 'hellos', 'errors', 'failures')
+
+  def __init__(self, addr, encoding = Encoding.JSON, options = None, subscription = None):
+    self.addr = addr # (ip_addr, port)
+    self.registered = self.seen = time.monotonic()
+    self.encoding = encoding
+    self.options = options or {} # HELLO options
+    self.subscription = subscription # None for everything
+    self.hellos = 0 # HELLO messages received
+    self.errors = 0 # Datagrams that could not be delivered
+    self.failures = 0 # Errors since the last HELLO
+
+
+class ClientRegistry:
+  """ Clients by address, least recently seen first """
+
+  TIMEOUT = 15 # Remove a client if not seen for this many seconds
+  MAX_CLIENTS = 64
+  MAX_PER_HOST = 8
+  MAX_FAILURES = 3 # Undelivered datagrams since the last HELLO before a client is removed
+
+  def __init__(self, timeout = TIMEOUT, max_clients = MAX_CLIENTS, max_per_host = MAX_PER_HOST, on_remove = None, max_failures = MAX_FAILURES):
+    """
+    :param timeout: seconds
+    :param max_clients: the maximum number of registrations
+    :param max_per_host: the maximum number of registrations from one IP address
+    :param on_remove: callback that receives the list of clients that expired or were evicted
+    :param max_failures: undelivered datagrams since the last HELLO before a client is removed, 0 never removes
+    """
+    self.timeout = timeout
+    self.max_clients = max_clients
+    self.max_per_host = max_per_host
+    self.max_failures = max_failures
+    self.on_remove = on_remove
+    self.clients = OrderedDict() # (ip_addr, port): Client
+    self.hosts = {} # ip_addr: number of registrations
+    self.expire_handle = None
+    self.evicted = 0 # Registrations removed because the registry was full
+    self.expired = 0
+    self.failed = 0 # Registrations removed because datagrams could not be delivered
+    self.failing = [] # Addresses to remove, see send_failed()
+    self.fail_handle = None
+
+
+  def __len__(self):
+    return len(self.clients)
+
+
+  def __contains__(self, addr):
+    return addr in self.clients
+
+
+  def __iter__(self):
+    return iter(self.clients)
+
+
+  def get(self, addr):
+    return self.clients.get(addr)
+
+
+  def values(self):
+    return self.clients.values()
+
+
+  def hello(self, addr, encoding = Encoding.JSON, options = None, subscription = None):
+    """
+    Registers a client or marks it as seen.
+
+    :return: (client, True if the client is new or changed its options)
+    """
+    client = self.clients.get(addr)
+    if client:
+      client.seen = time.monotonic()
+      client.failures = 0
+      self.clients.move_to_end(addr)
+      changed = client.encoding != encoding or client.options != (options or {})
+      client.encoding = encoding
+      client.options = options or {}
+      client.subscription = subscription
+    else:
+      self.make_room(addr[0])
+      client = self.clients[addr] = Client(addr, encoding, options, subscription)
+      self.hosts[addr[0]] = self.hosts.get(addr[0], 0) + 1
+      changed = True
+      if not self.expire_handle:
+        self.schedule()
+    client.hellos += 1
+    return client, changed
+
+
+  def make_room(self, host):
+    """ Evicts the least recently seen registrations of the host or of anyone """
+    evicted = []
+    if self.hosts.get(host, 0) >= self.max_per_host:
+      addr = next(addr for addr in self.clients if addr[0] == host)
+      evicted.append(self.pop(addr))
+    while len(self.clients) >= self.max_clients:
+      evicted.append(self.pop(next(iter(self.clients))))
+    if evicted:
+      self.evicted += len(evicted)
+      if self.on_remove:
+        self.on_remove(evicted)
+
+
+  def pop(self, addr):
+    """ Removes a client, returns it or None if unknown """
+    client = self.clients.pop(addr, None)
+    if client:
+      host = addr[0]
+      count = self.hosts[host] - 1
+      if count:
+        self.hosts[host] = count
+      else:
+        del self.hosts[host]
+    return client
+
+
+  def schedule(self):
+    """ Runs expire() when the least recently seen client expires """
+    for client in self.clients.values(): # Only the first one
+      delay = client.seen + self.timeout - time.monotonic()
+      self.expire_handle = asyncio.get_running_loop().call_later(max(0, delay), self.expire)
+      return
+    self.expire_handle = None
+
+
+  def expire(self):
+    deadline = time.monotonic() - self.timeout
+    expired = []
+    for addr, client in self.clients.items():
+      if client.seen > deadline:
+        break
+      expired.append(addr)
+    expired = [self.pop(addr) for addr in expired]
+    self.schedule()
+    if expired:
+      self.expired += len(expired)
+      if self.on_remove:
+        self.on_remove(expired)
+
+
+  def send_failed(self, addr):
+    """ Counts a datagram that could not be delivered, removes the client soon after max_failures of them """
+    client = self.clients.get(addr)
+    if not client:
+      return
+    client.errors += 1
+    client.failures += 1
+    if client.failures == self.max_failures:
+      self.failing.append(addr)
+      if not self.fail_handle: # Not now, this can be called while sending to the client
+        self.fail_handle = asyncio.get_running_loop().call_soon(self.remove_failing)
+
+
+  def remove_failing(self):
+    self.fail_handle = None
+    failing, self.failing = self.failing, []
+    removed = [client for client in map(self.pop, failing) if client]
+    if removed:
+      self.failed += len(removed)
+      if self.on_remove:
+        self.on_remove(removed)
+
+
+  def close(self):
+    if self.expire_handle:
+      self.expire_handle.cancel()
+      self.expire_handle = None
+    if self.fail_handle:
+      self.fail_handle.cancel()
+      self.fail_handle = None
@@ -0,0 +1,141 @@
+# Relates the free-running EasyLap timer to host time.
+#
+# Each timer packet gives a sample (device timer value, time.monotonic() when read). The
+# model is a line fitted with exponentially weighted least squares over the samples:
+#
+#   device seconds - host seconds = offset + drift * host seconds
+#
+# It keeps six running sums, so memory is constant and a sample costs O(1). Fitting the
+# difference instead of the device time itself keeps the numbers small enough for doubles.
+# The timer is 32-bit and rolls over; it is unwrapped first. A sample that is far from the
+# model (the device was reset, e.g. after a reconnect) starts a new model.
+
+import math
+import time
+
+
+class ClockSync:
+  """ Linear model between device timer ticks and host time """
+
+  MASK = 0xFFFFFFFF
+  HALF = 0x80000000
+  TICKS_PER_SECOND = 1000
+  HALF_LIFE = 120 # Samples, about two minutes of timer packets
+  MAX_ERROR = 0.5 # Seconds, a sample further than this from the model resets it
+  KEY_HOST_TIME = 'host_time'
+  KEY_HOST_ERROR = 'host_error'
+
+  def __init__(self, ticks_per_second = TICKS_PER_SECOND, half_life = HALF_LIFE):
+    self.ticks_per_second = ticks_per_second
+    self.decay = 0.5 ** (1 / half_life)
+    self.resets = 0 # Times the model started over
+    self.reset()
+
+
+  def reset(self):
+    """ Forgets everything, e.g. after the device was reconnected """
+    self.raw = None # Last raw timer value
+    self.ticks = 0 # Unwrapped ticks since the first sample
+    self.origin = None # time.monotonic() of the first sample
+    self.samples = 0
+    self.w = self.x = self.y = self.xx = self.xy = self.yy = 0.0
+    self.model = None # (offset, drift, residual), computed when needed
+
+
+  def unwrap(self, timer_value):
+    """ Unwrapped ticks of a timer value close to the latest sample """
+    return self.ticks + ((timer_value - self.raw + self.HALF) & self.MASK) - self.HALF
+
+
+  def add(self, timer_value, host):
+    """
+    Adds a sample.
+
+    :param timer_value: the raw device timer value
+    :param host: time.monotonic() when the value was read
+    """
+    if self.raw is None:
+      self.raw = timer_value
+      self.origin = host
+    self.ticks = self.unwrap(timer_value)
+    self.raw = timer_value
+    x = host - self.origin
+    y = self.ticks / self.ticks_per_second - x
+    if self.samples >= 2:
+      offset, drift, residual = self.fit()
+      if abs(y - offset - drift * x) > self.MAX_ERROR:
+        self.resets += 1
+        self.reset()
+        self.add(timer_value, host)
+        return
+    d = self.decay
+    self.w = self.w * d + 1
+    self.x = self.x * d + x
+    self.y = self.y * d + y
+    self.xx = self.xx * d + x * x
+    self.xy = self.xy * d + x * y
+    self.yy = self.yy * d + y * y
+    self.samples += 1
+    self.model = None
+
+
+  def fit(self):
+    """ Returns (offset, drift, residual standard deviation), all in seconds """
+    if self.model is None:
+      w = self.w
+      mx = self.x / w
+      my = self.y / w
+      var_x = self.xx / w - mx * mx
+      cov = self.xy / w - mx * my
+      drift = cov / var_x if var_x > 1e-9 else 0.0
+      offset = my - drift * mx
+      residual = max(0.0, self.yy / w - my * my - drift * cov)
+      self.model = (offset, drift, math.sqrt(residual))
+    return self.model
+
+
+  def ready(self):
+    return self.samples >= 2
+
+
+  def host_time(self, timer_value):
+    """ Returns the time.monotonic() at which the device timer had this value, None without a model """
+    if not self.ready():
+      return None
+    offset, drift, residual = self.fit()
+    device = self.unwrap(timer_value) / self.ticks_per_second
+    return self.origin + (device - offset) / (1 + drift)
+
+
+  def ticks_at(self, host):
+    """ Returns the raw device timer value at a time.monotonic() time, None without samples """
+    if self.raw is None:
+      return None
+    x = host - self.origin
+    device = x # Seconds since the first sample
+    if self.ready():
+      offset, drift, residual = self.fit()
+      device += offset + drift * x
+    first = self.raw - self.ticks # Raw value of the first sample
+    return (first + int(round(device * self.ticks_per_second))) & self.MASK
+
+
+  def error(self):
+    """ Uncertainty of a conversion, seconds """
+    return self.fit()[2] if self.ready() else None
+
+
+  def drift_ppm(self):
+    return self.fit()[1] * 1e6 if self.ready() else None
+
+
+  def annotate(self, packet, timer_value):
+    """ Adds the estimated wall time of a timer value, and its uncertainty, to a packet """
+    host = self.host_time(timer_value)
+    if host is not None:
+      packet[self.KEY_HOST_TIME] = host + (time.time() - time.monotonic())
+      packet[self.KEY_HOST_ERROR] = self.error()
+
+
+  def snapshot(self):
+    return {'samples': self.samples, 'resets': self.resets, 'drift_ppm': self.drift_ppm(), 'error': self.error()}
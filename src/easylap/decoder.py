@@ -0,0 +1,109 @@
+# Incremental decoder for the Robitronic serial protocol.
+# See http://www.flipsideracing.org/projects/fslapcounter/wiki/RobitronicSerial
+#
+# Bytes are appended to a bytearray and consumed by moving a read offset, so neither
+# discarding garbage nor consuming a frame copies the rest of the buffer. Fields are
+# extracted in place with struct.unpack_from. The consumed prefix is dropped only when
+# the buffer is empty or the offset grows past COMPACT_THRESHOLD.
+
+import struct
+
+
+class FrameDecoder:
+  """ Robitronic frame decoder shared by AioEasyLapDevice and EasyLapDevice """
+
+  TIMER = 0x0B # Timer packet: first byte is the length, 11 bytes
+  CAR = 0x0D # Car packet: first byte is the length, 13 bytes
+  TIMER_MARKER = 0x83 # Third byte of a timer packet
+  CAR_MARKER = 0x84 # Third byte of a car packet
+  COMPACT_THRESHOLD = 4096
+
+  TIMER_STRUCT = struct.Struct('<3xI') # timer value at offset 3
+  CAR_STRUCT = struct.Struct('<3xH2xI') # uid at offset 3, timer value at offset 7
+
+  def __init__(self):
+    self.buf = bytearray()
+    self.offset = 0
+    self.bytes = 0 # Number of bytes fed
+    self.garbage = 0 # Number of bytes discarded while looking for a frame
+    self.resyncs = 0 # Number of times the decoder lost a frame boundary
+    self.frames = 0 # Number of frames decoded
+    self.syncing = False # Discarding garbage
+
+
+  def feed(self, chunk):
+    """
+    Appends a chunk read from the device and decodes all complete frames.
+
+    :param chunk: bytes, bytearray or a list of ints
+    :return: an iterator of (frame_type, uid, timer_value) tuples. uid is 0 for timer packets.
+    """
+    self.buf.extend(chunk) # Now, not when the iterator is first advanced
+    self.bytes += len(chunk)
+    return self.decode()
+
+
+  def decode(self):
+    """ Generator of the complete frames found in the buffer """
+    buf = self.buf
+    pos = self.offset
+    end = len(buf)
+    try:
+      while pos < end:
+        length = buf[pos]
+        if length == self.TIMER:
+          marker = self.TIMER_MARKER
+        elif length == self.CAR:
+          marker = self.CAR_MARKER
+        else:
+          pos += 1 # Garbage, discard one
+          self.discard()
+          continue
+        if end - pos >= 3 and buf[pos + 2] != marker: # garbage? discard one
+          pos += 1
+          self.discard()
+          continue
+        if end - pos < length: # Incomplete, wait for more
+          break
+        if length == self.TIMER:
+          uid = 0
+          timer_value, = self.TIMER_STRUCT.unpack_from(buf, pos)
+        else:
+          uid, timer_value = self.CAR_STRUCT.unpack_from(buf, pos)
+        pos += length
+        self.offset = pos
+        self.frames += 1
+        self.syncing = False
+        yield (length, uid, timer_value)
+    finally:
+      self.offset = pos
+      self.compact()
+
+
+  def discard(self):
+    self.garbage += 1
+    if not self.syncing:
+      self.syncing = True
+      self.resyncs += 1
+
+
+  def compact(self):
+    """ Drops the consumed part of the buffer when it is cheap or when it grew too large """
+    pos = self.offset
+    if pos == len(self.buf):
+      self.buf.clear()
+      self.offset = 0
+    elif pos >= self.COMPACT_THRESHOLD:
+      del self.buf[:pos]
+      self.offset = 0
+
+
+  def pending(self):
+    """ Returns the number of bytes waiting for the rest of a frame """
+    return len(self.buf) - self.offset
+
+
+  def reset(self):
+    """ Discards all buffered bytes, e.g. after reconnecting """
+    self.buf.clear()
+    self.offset = 0
@@ -13,17 +13,11 @@ Use the aiodevice module instead of this for asynchronous operations.
 
 """
 
-import sys
+import time
+from . import backend
 from .base import Base, LogOptions
-
-try:
-  from cp2110 import CP2110Device, UARTConfig, PARITY, FLOW_CONTROL, DATA_BITS, STOP_BITS, RX_TX_MAX
-except ImportError:
-  try:
-    from .fake.cp2110 import *
-  except ImportError as e:
-    print('Cannot import: {} - exiting.'.format(e))
-    sys.exit(1)
+from .decoder import FrameDecoder
+from .frame import Frame
     
    
 
@@ -42,57 +36,35 @@ class EasyLapDevice(Base):
     super().__init__('EasyLapDevice', log_options)
   
   
-  def receive(self, callback):
+  def receive(self, callback, frames = False):
     """ Receives from a EasyLap device.
     
     :param callback: the callback called when data is received.
+    :param frames: call callback(frame) with a Frame, as AioEasyLapDevice yields, instead of callback(t=timer value, c=car uid or None)
     
     """
     if not callback:
       raise RuntimeError('A callback is required')
     
     # Main loop
-    d = CP2110Device(pid=self.EASYLAP_PID)
-    d.set_uart_config(UARTConfig(
-      baud=38400, parity=PARITY.NONE, flow_control=FLOW_CONTROL.DISABLED,
-      data_bits=DATA_BITS.EIGHT, stop_bits=STOP_BITS.SHORT))
+    cp2110 = backend.cp2110()
+    d = cp2110.CP2110Device(pid=self.EASYLAP_PID)
+    d.set_uart_config(cp2110.UARTConfig(
+      baud=38400, parity=cp2110.PARITY.NONE, flow_control=cp2110.FLOW_CONTROL.DISABLED,
+      data_bits=cp2110.DATA_BITS.EIGHT, stop_bits=cp2110.STOP_BITS.SHORT))
     d.enable_uart()
   
-    buf = []
+    decoder = FrameDecoder()
   
     while True:
-      chunk = d.read(RX_TX_MAX + 1)
+      chunk = d.read(cp2110.RX_TX_MAX + 1)
       while chunk:
-        buf += chunk
-        time.sleep(0.025)
-        chunk = d.read(RX_TX_MAX + 1)
-        
-      if not buf:
+        received_at = time.monotonic()
+        for frame_type, uid, timer_value in decoder.feed(chunk):
+          if frames:
+            callback(Frame(frame_type, uid, timer_value, received_at))
+          else:
+            callback(t = timer_value, c = uid if frame_type == FrameDecoder.CAR else None)
         time.sleep(0.025)
-        continue
-  
-      # print(['%.2X' % int(x) for x in buf])
-  
-      if buf[0] == 0x0B: # Timer packet
-        if len(buf) >= 3 and buf[2] != 0x83: # garbage? discard one
-          buf = buf[1:]
-        elif len(buf) >= 0x0B: # 11 bytes
-          timer_value = (buf[3] | buf[4] << 8 | buf[5] << 16 | buf[6] << 32)
-          # print("timer: %s" % timer_value)
-          callback(t = timer_value, c = None)
-          buf = buf[0x0B + 1:]
-           
-      elif buf[0] == 0x0D: # Car packet
-        if len(buf) >= 3 and buf[2] != 0x84: # garbage? discard one
-          buf = buf[1:]
-        elif len(buf) >= 0x0D: # 13 bytes
-          uid = (buf[3] | buf[4] << 8)
-          timer_value = (buf[7] | buf[8] << 8 | buf[9] << 16 | buf[10] << 32)
-          # print("car: %s: %s" % (uid, timer_value))
-          callback(t = timer_value, c = uid)
-          buf = buf[0x0D + 1:]
-      
-      else:  
-        buf = buf[1:]
-
-  
\ No newline at end of file
+        chunk = d.read(cp2110.RX_TX_MAX + 1)
+      time.sleep(0.025)
@@ -1,10 +1,21 @@
 # Fake cp2110 module that returns test data.
 # Useful on Mac where cp2110 does not work:
 # ImportError: Unable to load any of the following libraries: libhidapi-hidraw.so ...
+#
+# Without configuration, read() returns one chunk of fake_data per second. For load
+# testing, set CP2110Device.stream (and CP2110Device.speed) or the EASYLAP_FAKE_STREAM
+# (and EASYLAP_FAKE_SPEED) environment variables, see the stream module. Set
+# CP2110Device.present to False to unplug the device: opening and reading fail until it
+# is set to True again. CP2110Device.devices (or EASYLAP_FAKE_DEVICES) is the number of
+# devices that enumerate() lists; CP2110Device.streams can give each serial number its own
+# stream.
 
+import os
 import time
 from enum import IntEnum, unique
 
+__all__ = ['CP2110Device', 'UARTConfig', 'PARITY', 'FLOW_CONTROL', 'DATA_BITS', 'STOP_BITS', 'RX_TX_MAX'] # Not enumerate
+
 @unique
 class PARITY(IntEnum):
   """UARTConfig parity values."""
@@ -37,6 +48,12 @@ class STOP_BITS(IntEnum):
   
 class CP2110Device():
   
+  stream = None # An iterable of (due, chunk), see the stream module
+  speed = 1.0 # 1 is real time, 0 is as fast as possible
+  present = True # False: the device is unplugged
+  devices = 1 # Listed by enumerate()
+  streams = {} # Serial number: stream, overrides stream
+  
   last = 0
   fake_data = [
     [0x0B, 0x00, 0x83, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
@@ -49,7 +66,19 @@ class CP2110Device():
   fake_index = 0
 
   def __init__(self, vid=None, pid=None, serial=None, path=None):
+    if not CP2110Device.present:
+      raise OSError('open failed')
     print('Development: Using fake cp2110 library')
+    stream = self.streams.get(serial, self.stream)
+    speed = self.speed
+    if stream is None and os.environ.get('EASYLAP_FAKE_STREAM'):
+      from .stream import parse
+      stream = parse(os.environ['EASYLAP_FAKE_STREAM'])
+      speed = float(os.environ.get('EASYLAP_FAKE_SPEED', speed))
+    self.chunks = iter(stream) if stream is not None else None
+    self.speed = speed
+    self.started = time.monotonic()
+    self.next_chunk = None
   
   def set_uart_config(self, config):
     pass
@@ -57,7 +86,14 @@ class CP2110Device():
   def enable_uart(self):
     pass
   
+  def close(self):
+    pass
+  
   def read(self, size=None):
+    if not CP2110Device.present:
+      raise OSError('read error')
+    if self.chunks is not None:
+      return self.read_stream()
     now = time.time()
     if now - self.last > 1:
       self.last = now
@@ -68,6 +104,24 @@ class CP2110Device():
       return []
 
 
+  def read_stream(self):
+    """ Returns the next chunk of the stream if it is due, otherwise an empty list """
+    if self.next_chunk is None:
+      self.next_chunk = next(self.chunks, None)
+      if self.next_chunk is None: # The end
+        return []
+    due, chunk = self.next_chunk
+    if self.speed > 0 and (time.monotonic() - self.started) * self.speed < due:
+      return []
+    self.next_chunk = None
+    return chunk
+
+
+def enumerate(vid=None, pid=None):
+  count = int(os.environ.get('EASYLAP_FAKE_DEVICES', CP2110Device.devices))
+  return [{'serial_number': 'FAKE{}'.format(i), 'path': 'fake{}'.format(i).encode()} for i in range(count)]
+
+
 class UARTConfig:
   def __init__(self, baud, parity, flow_control, data_bits, stop_bits):
     pass
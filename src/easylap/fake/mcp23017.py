@@ -1,26 +1,59 @@
 # Fake adafruit_mcp230xx.mcp23017 module
+#
+# Like the real driver, gpio and iodir are the 16-bit GPIOA/GPIOB and IODIRA/IODIRB
+# port registers: reading or writing one is one I2C transaction. Setting the value of
+# a single pin is a read-modify-write of the port, two transactions. The transactions
+# counter makes this visible in tests.
 
 class Fake_Pin:
   """ A fake pin """
-  def __init__(self, i2c, index):
-    self.i2c = i2c
+  def __init__(self, mcp, index):
+    self.mcp = mcp
     self.index = index
-    self.value = False
-    self.output = False
+    
+  @property
+  def value(self):
+    return bool(self.mcp.gpio & (1 << self.index))
+    
+  @value.setter
+  def value(self, value):
+    gpio = self.mcp.gpio
+    self.mcp.gpio = gpio | (1 << self.index) if value else gpio & ~(1 << self.index)
     
   def switch_to_output(self, value):
-    self.output = value
+    self.value = value
+    self.mcp.iodir = self.mcp.iodir & ~(1 << self.index)
   
     
 class MCP23017:
   """ A fake MCP23017 device """
   
-  pins = []
-  
   def __init__(self, i2c):
-    for i in range(0, 16):
-      self.pins.append(Fake_Pin(i2c, i))
+    self.i2c = i2c
+    self.transactions = 0 # I2C transactions so far
+    self._gpio = 0x0000
+    self._iodir = 0xFFFF # All inputs after reset
+    self.pins = [Fake_Pin(self, i) for i in range(0, 16)]
+  
+  @property
+  def gpio(self):
+    self.transactions += 1
+    return self._gpio
+  
+  @gpio.setter
+  def gpio(self, value):
+    self.transactions += 1
+    self._gpio = value & 0xFFFF
+  
+  @property
+  def iodir(self):
+    self.transactions += 1
+    return self._iodir
   
+  @iodir.setter
+  def iodir(self, value):
+    self.transactions += 1
+    self._iodir = value & 0xFFFF
   
   def get_pin(self, index):
-    return self.pins[index]
\ No newline at end of file
+    return self.pins[index]
@@ -0,0 +1,167 @@
+# Byte streams for the fake cp2110 module, for load testing without hardware.
+#
+# A stream is an iterable of (due, chunk): due is the number of seconds after the start
+# of the stream when the chunk is available, chunk is at most RX_TX_MAX bytes.
+#
+# SyntheticStream generates Robitronic frames for a number of cars, with timer packets,
+# garbage bytes and random chunk sizes. RecordedStream replays a raw byte capture paced
+# at the serial baud rate. SyntheticStream.capture() writes such a capture.
+#
+# The fake CP2110Device picks a stream from the EASYLAP_FAKE_STREAM environment variable:
+#
+#   synthetic:cars=20,lap=8,jitter=0.5,noise=0.1,chunk=1-63,seed=1
+#   file:/path/to/capture.bin
+#
+# and replays it at the speed in EASYLAP_FAKE_SPEED: 1 is real time (the default), 10 is
+# ten times faster, 0 is as fast as the reader can go.
+
+import heapq
+import random
+import struct
+
+RX_TX_MAX = 63
+
+TIMER_FRAME = struct.Struct('<BBBI4x') # 11 bytes, the timer value at offset 3
+CAR_FRAME = struct.Struct('<BBBH2xI2x') # 13 bytes, the uid at offset 3, the timer value at offset 7
+GARBAGE = bytes(b for b in range(256) if b not in (0x0B, 0x0D)) # Never looks like a frame start
+
+
+def timer_frame(timer_value):
+  return TIMER_FRAME.pack(0x0B, 0x00, 0x83, timer_value & 0xFFFFFFFF)
+
+
+def car_frame(uid, timer_value):
+  return CAR_FRAME.pack(0x0D, 0x00, 0x84, uid, timer_value & 0xFFFFFFFF)
+
+
+class SyntheticStream:
+  """ Generated race traffic """
+
+  def __init__(self, cars = 20, lap = 8.0, jitter = 0.5, noise = 0.0, chunk = (1, RX_TX_MAX), timer_interval = 1.0, ticks = 1000, timer_start = 0, duration = None, seed = None, offset = 0.0):
+    """
+    :param cars: the number of cars on track
+    :param lap: the mean lap time in seconds
+    :param jitter: the standard deviation of the lap time in seconds
+    :param noise: the mean number of garbage bytes after each frame
+    :param chunk: (min, max) size of a chunk returned by a read
+    :param timer_interval: seconds between timer packets, 0 for none
+    :param ticks: device timer ticks per second
+    :param timer_start: the device timer value at the start, e.g. close to 0xFFFFFFFF to test the rollover
+    :param duration: seconds of traffic, None for endless
+    :param seed: the random seed, for a reproducible stream
+    :param offset: seconds added to every crossing, e.g. for a receiver at a sector split with the same seed
+    """
+    self.cars = cars
+    self.lap = lap
+    self.jitter = jitter
+    self.noise = noise
+    self.chunk = (max(1, chunk[0]), min(RX_TX_MAX, chunk[1]))
+    self.timer_interval = timer_interval
+    self.ticks = ticks
+    self.timer_start = timer_start
+    self.duration = duration
+    self.seed = seed
+    self.offset = offset
+
+
+  def frames(self):
+    """ Yields (due, frame bytes, uid), uid is 0 for timer packets """
+    rand = random.Random(self.seed)
+    uids = rand.sample(range(1, 0x10000), self.cars)
+    events = [(rand.uniform(0, self.lap) + self.offset, uid) for uid in uids] # First crossing
+    if self.timer_interval > 0:
+      events.append((0.0, 0))
+    heapq.heapify(events)
+    while events:
+      due, uid = heapq.heappop(events)
+      if self.duration is not None and due > self.duration:
+        return
+      timer_value = self.timer_start + int(due * self.ticks)
+      if uid:
+        yield due, car_frame(uid, timer_value), uid
+        heapq.heappush(events, (due + max(self.lap / 10, rand.gauss(self.lap, self.jitter)), uid))
+      else:
+        yield due, timer_frame(timer_value), uid
+        heapq.heappush(events, (due + self.timer_interval, uid))
+
+
+  def __iter__(self):
+    rand = random.Random(None if self.seed is None else self.seed + 1)
+    low, high = self.chunk
+    for due, frame, uid in self.frames():
+      data = frame
+      if self.noise > 0:
+        count = int(self.noise) + (1 if rand.random() < self.noise % 1 else 0)
+        data += bytes(rand.choice(GARBAGE) for i in range(count))
+      while data:
+        size = rand.randint(low, high)
+        yield due, data[:size]
+        data = data[size:]
+
+
+  def capture(self, path):
+    """ Writes the stream to a raw capture file, requires a duration """
+    if self.duration is None:
+      raise RuntimeError('A duration is required')
+    with open(path, 'wb') as f:
+      for due, chunk in self:
+        f.write(chunk)
+
+
+class RecordedStream:
+  """ A raw byte capture, paced at the serial baud rate """
+
+  def __init__(self, path, baud = 38400, chunk = (1, RX_TX_MAX), loop = False, seed = None):
+    """
+    :param path: the capture file
+    :param baud: the serial speed, 10 bits per byte
+    :param chunk: (min, max) size of a chunk returned by a read
+    :param loop: start over at the end
+    :param seed: the random seed for the chunk sizes
+    """
+    with open(path, 'rb') as f:
+      self.data = f.read()
+    self.byte_time = 10 / baud
+    self.chunk = (max(1, chunk[0]), min(RX_TX_MAX, chunk[1]))
+    self.loop = loop
+    self.seed = seed
+
+
+  def __iter__(self):
+    rand = random.Random(self.seed)
+    low, high = self.chunk
+    data = self.data
+    start = 0.0
+    while data:
+      pos = 0
+      while pos < len(data):
+        size = rand.randint(low, high)
+        yield start + (pos + size) * self.byte_time, data[pos:pos + size]
+        pos += size
+      if not self.loop:
+        return
+      start += len(data) * self.byte_time
+
+
+def parse(spec):
+  """
+  Creates a stream from a specification, see the top of this module.
+
+  :param spec: 'synthetic:key=value,...' or 'file:path'
+  """
+  kind, _, args = spec.partition(':')
+  if kind == 'file':
+    return RecordedStream(args)
+  if kind != 'synthetic':
+    raise ValueError('Unknown stream: {}'.format(spec))
+  options = {}
+  for option in filter(None, args.split(',')):
+    key, _, value = option.partition('=')
+    if key == 'chunk':
+      low, _, high = value.partition('-')
+      options[key] = (int(low), int(high or low))
+    elif key in ('cars', 'ticks', 'timer_start', 'seed'):
+      options[key] = int(value, 0)
+    else:
+      options[key] = float(value)
+  return SyntheticStream(**options)
@@ -0,0 +1,168 @@
+# Sends each outgoing datagram to all registered clients.
+#
+# Clients are grouped by a key (the wire encoding) so that a packet is encoded once per
+# group rather than once per client. The destination addresses of each group are kept in
+# an immutable tuple that is rebuilt only when a client is added, removed or changes group,
+# so the per-packet path does not copy or scan the client registry. Optionally, packets
+# that arrive within a short window are coalesced into one datagram per client.
+#
+# CPython's socket module has no sendmmsg(), so every datagram goes through
+# transport.sendto(), which writes immediately when the socket is writable. When that
+# fails, asyncio calls the protocol's error_received() from within sendto(); the address
+# being sent to is in `sending` at that time, and the protocol calls unsent(). On Linux a
+# sendto() can also fail with the error of an earlier datagram (see UnicastServer), the
+# datagram is then sent once more rather than lost.
+
+import asyncio
+
+
+class Fanout:
+  """ Fan-out of datagrams to snapshots of client addresses """
+
+  SEPARATOR = b'\n' # Between coalesced packets, unless the group has its own
+  MAX_DATAGRAM = 1400 # Flush early rather than risk IP fragmentation on Wi-Fi
+
+  def __init__(self, coalesce = 0, separators = None):
+    """
+    :param coalesce: seconds to wait for more packets before sending, 0 sends immediately
+    :param separators: separator between coalesced packets, by group key
+    """
+    self.transport = None
+    self.groups = {} # Group key: immutable snapshot of (ip_addr, port)
+    self.coalesce = coalesce
+    self.separators = separators or {}
+    self.pending = {} # Group key: list of packets
+    self.pending_size = {}
+    self.flush_handle = None
+    self.sent = 0 # Datagrams sent
+    self.errors = 0 # Datagrams that could not be sent or delivered
+    self.client_sent = None # Datagrams sent per address, counted only when set to a dict
+    self.sending = None # The address of the sendto() in progress
+    self.not_sent = False # Set by unsent() when the sendto() in progress failed
+    self.stale = False # Set by unsent() when it failed with the error of an earlier datagram
+    self.on_error = None # Called with the address of a datagram that could not be sent or delivered
+
+
+  def update(self, groups):
+    """
+    Rebuilds the snapshots. Call when the set of clients changes.
+
+    :param groups: group key: iterable of addresses
+    """
+    self.flush() # Pending packets belong to the old membership
+    self.groups = {key: tuple(addresses) for key, addresses in groups.items() if addresses}
+    if self.client_sent:
+      current = set(addr for addresses in self.groups.values() for addr in addresses)
+      for addr in [addr for addr in self.client_sent if addr not in current]:
+        del self.client_sent[addr]
+
+
+  def send(self, data, key = None):
+    """
+    Sends data now or at the end of the coalescing window.
+
+    :param data: bytes
+    :param key: the group to send to, None for all groups
+    """
+    if key is None:
+      for key in self.groups:
+        self.send(data, key)
+      return
+    if not self.coalesce:
+      self.send_all(data, self.groups.get(key))
+      return
+    separator = self.separators.get(key, self.SEPARATOR)
+    size = self.pending_size.get(key, 0)
+    if size + len(data) + len(separator) > self.MAX_DATAGRAM:
+      self.flush_group(key)
+      size = 0
+    self.pending.setdefault(key, []).append(data)
+    self.pending_size[key] = size + len(data) + len(separator)
+    if not self.flush_handle:
+      self.flush_handle = asyncio.get_running_loop().call_later(self.coalesce, self.flush)
+
+
+  def send_now(self, data, key):
+    """ Sends data to a group in its own datagram, after what is pending, e.g. JSON to binary clients """
+    self.flush_group(key)
+    self.send_all(data, self.groups.get(key))
+
+
+  def flush(self):
+    """ Sends the coalesced packets, one datagram per client """
+    if self.flush_handle:
+      self.flush_handle.cancel()
+      self.flush_handle = None
+    for key in list(self.pending):
+      self.flush_group(key)
+
+
+  def flush_group(self, key):
+    packets = self.pending.pop(key, None)
+    self.pending_size.pop(key, None)
+    if packets:
+      self.send_all(self.separators.get(key, self.SEPARATOR).join(packets), self.groups.get(key))
+
+
+  def send_all(self, data, addresses):
+    """ Sends one datagram to each address """
+    transport = self.transport
+    if not transport or not addresses:
+      return
+    sendto = transport.sendto
+    client_sent = self.client_sent
+    for addr in addresses:
+      self.sending = addr
+      try:
+        sendto(data, addr)
+      except OSError:
+        self.not_sent = True
+      if self.not_sent and not self.retry(data, addr):
+        continue
+      self.sent += 1
+      if client_sent is not None:
+        client_sent[addr] = client_sent.get(addr, 0) + 1
+    self.sending = None
+
+
+  def unsent(self, stale = False):
+    """
+    Called by the protocol when the sendto() in progress failed.
+
+    :param stale: True if it failed with the error of an earlier datagram to another address
+    """
+    self.not_sent = True
+    self.stale = stale
+
+
+  def retry(self, data, addr):
+    """ Sends again once if the last sendto() failed because of an earlier datagram, returns True if sent """
+    stale = self.stale
+    self.not_sent = self.stale = False
+    if stale:
+      try:
+        self.transport.sendto(data, addr)
+      except OSError:
+        self.not_sent = True
+      if not self.not_sent:
+        return True
+      stale = self.stale
+      self.not_sent = self.stale = False
+    if stale: # Lost because of yet another address, not this one's fault
+      self.errors += 1
+    else:
+      self.failed(addr)
+    return False
+
+
+  def failed(self, addr):
+    """ Counts a datagram that could not be sent or delivered to an address """
+    self.errors += 1
+    if self.on_error:
+      self.on_error(addr)
+
+
+  def close(self):
+    """ Sends what is pending and stops """
+    self.flush()
+    self.transport = None
@@ -0,0 +1,133 @@
+# A frame read from an EasyLAP receiver, as it travels through easylapd.
+#
+# Both device classes used to hand out a new dict per frame (or call back with t= and c=).
+# A Frame keeps the fields every frame has in __slots__: frame type, uid, timer value, the
+# time it was read and, once sent, its sequence number. Keys added on the way (host_time,
+# device...) go to a dict created only when needed. A Frame reads like the dict it
+# replaces, frame['uid'], frame.get('uid'), 'device' in frame and dict(frame) work, so the
+# race, journal, clock and subscription code takes either.
+#
+# The datagram of each wire format is kept on the frame once encoded (see the wire
+# module), so a frame is encoded once however many clients or groups need it. The
+# server drops the encodings when the frame has been sent, so the RESEND history does not
+# keep them; changing a key drops them too.
+
+from .decoder import FrameDecoder
+
+
+class Frame:
+  """ A timer or car frame """
+
+  __slots__ = ('type', 'uid', 'time', 'received_at', 'seq', 'extra', 'json', 'binary')
+
+  KEY_TIME = 'time'
+  KEY_UID = 'uid'
+  KEY_SEQ = 'seq'
+
+  def __init__(self, frame_type, uid, timer_value, received_at = None):
+    """
+    :param frame_type: FrameDecoder.TIMER or FrameDecoder.CAR
+    :param uid: the transponder uid, 0 for a timer frame
+    :param timer_value: the device timer value
+    :param received_at: time.monotonic() when the frame was read, None if not read from a device
+    """
+    self.type = frame_type
+    self.uid = uid
+    self.time = timer_value
+    self.received_at = received_at
+    self.seq = None # Set by UnicastServer.send_packet()
+    self.extra = None # Other keys, e.g. host_time
+    self.json = None # Encoded, see Encoding.encode()
+    self.binary = None
+
+
+  @classmethod
+  def from_packet(cls, packet):
+    """ Returns a frame with the time and uid of a packet """
+    uid = packet[cls.KEY_UID]
+    return cls(FrameDecoder.CAR if uid else FrameDecoder.TIMER, uid, packet[cls.KEY_TIME])
+
+
+  def __getitem__(self, key):
+    if key == self.KEY_TIME:
+      return self.time
+    if key == self.KEY_UID:
+      return self.uid
+    if key == self.KEY_SEQ and self.seq is not None:
+      return self.seq
+    if self.extra is None:
+      raise KeyError(key)
+    return self.extra[key]
+
+
+  def __setitem__(self, key, value):
+    self.json = self.binary = None
+    if key == self.KEY_TIME:
+      self.time = value
+    elif key == self.KEY_UID:
+      self.uid = value
+    elif key == self.KEY_SEQ:
+      self.seq = value
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+
+
+  def get(self, key, default = None):
+    if key == self.KEY_TIME:
+      return self.time
+    if key == self.KEY_UID:
+      return self.uid
+    if key == self.KEY_SEQ and self.seq is not None:
+      return self.seq
+    if self.extra is None:
+      return default
+    return self.extra.get(key, default)
+
+
+  def __contains__(self, key):
+    if key == self.KEY_TIME or key == self.KEY_UID:
+      return True
+    if key == self.KEY_SEQ:
+      return self.seq is not None
+    return self.extra is not None and key in self.extra
+
+
+  def to_dict(self):
+    """ Returns the frame as the dict sent to JSON clients """
+    packet = {self.KEY_TIME: self.time, self.KEY_UID: self.uid}
+    if self.extra:
+      packet.update(self.extra)
+    if self.seq is not None:
+      packet[self.KEY_SEQ] = self.seq
+    return packet
+
+
+  def keys(self):
+    return self.to_dict().keys()
+
+
+  def __iter__(self):
+    return iter(self.to_dict())
+
+
+  def __len__(self):
+    return 2 + (self.seq is not None) + (len(self.extra) if self.extra else 0)
+
+
+  def __eq__(self, other):
+    if isinstance(other, Frame):
+      other = other.to_dict()
+    return self.to_dict() == other if isinstance(other, dict) else NotImplemented
+
+
+  __hash__ = None
+
+
+  def items(self):
+    return self.to_dict().items()
+
+
+  def __repr__(self):
+    return repr(self.to_dict())
@@ -0,0 +1,244 @@
+# Append-only race journal.
+#
+# Every decoded frame is appended to a segment file as a fixed-size little-endian record:
+#
+#   host time (8 bytes, double, time.time()) | type (1 byte) | device (1 byte) | uid (2 bytes) | timer (4 bytes)
+#
+# device is the index of the receiver in --device order, 0 for start/finish or a single
+# device (older journals have 0 there). The timers of the receivers are not synchronized,
+# replay counts laps from device 0 only.
+#
+# A segment starts with a 16-byte header (MAGIC, padded) and holds one race; a new race
+# starts a new segment. The records are packed on the event loop and written by a writer
+# thread, so a slow SD card never blocks the loop. JournalReader memory-maps a segment and
+# unpacks records in place, which makes scanning a whole season cheap.
+
+import glob
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from .base import Base, LogOptions
+from .frame import Frame
+
+
+class Journal:
+  """ Journal file format """
+
+  MAGIC = b'EASYLAPJ1'
+  HEADER_SIZE = 16
+  RECORD = struct.Struct('<dBBHI')
+  SUFFIX = '.journal'
+  TIMER = 0x0B
+  CAR = 0x0D
+
+  KEY_TIME = 'time'
+  KEY_UID = 'uid'
+  KEY_DEVICE = 'device'
+
+
+  @classmethod
+  def header(cls):
+    return cls.MAGIC.ljust(cls.HEADER_SIZE, b'\0')
+
+
+  @classmethod
+  def segments(cls, path):
+    """ Returns the segment files in a directory, oldest first, or [path] for a file """
+    if os.path.isdir(path):
+      return sorted(glob.glob(os.path.join(path, '*' + cls.SUFFIX)), key=cls.segment_key)
+    return [path]
+
+
+  @classmethod
+  def segment_key(cls, path):
+    """ Sorts 'race-<date>-<time>-<index>' after 'race-<date>-<time>' """
+    name = os.path.basename(path)[:-len(cls.SUFFIX)]
+    base, _, index = name.rpartition('-')
+    if base.count('-') == 2 and index.isdigit():
+      return (base, int(index))
+    return (name, 0)
+
+
+class JournalWriter(Base):
+  """ Writes frames to journal segments from a writer thread """
+
+  FSYNC_INTERVAL = 1.0
+
+  def __init__(self, directory, fsync = FSYNC_INTERVAL, log_options = LogOptions()):
+    """
+    :param directory: where to create the segments
+    :param fsync: seconds between fsync calls, 0 after every record, negative to let the OS decide
+    :param log_options: the log options
+    """
+    super().__init__('JournalWriter', log_options)
+    self.directory = directory
+    self.fsync = fsync
+    self.records = 0 # Records queued
+    self.stopped = False # The writer thread stopped on an error, nothing is queued any more
+    os.makedirs(directory, exist_ok=True)
+    self.queue = queue.SimpleQueue()
+    self.thread = threading.Thread(target=self.run, name='JournalWriter', daemon=True)
+    self.thread.start()
+    self.rotate()
+
+
+  def write(self, packet, host_time = None, device = 0):
+    """
+    Appends a frame. Cheap, does not wait for the disk.
+
+    :param packet: a dict, e.g. {'time': timer_value, 'uid': uid}
+    :param host_time: time.time() when the frame was received, now if None
+    :param device: the index of the receiver, 0 for start/finish
+    """
+    if self.stopped:
+      return
+    uid = packet[Journal.KEY_UID]
+    self.queue.put(Journal.RECORD.pack(
+      time.time() if host_time is None else host_time,
+      Journal.CAR if uid else Journal.TIMER, device, uid, packet[Journal.KEY_TIME] & 0xFFFFFFFF))
+    self.records += 1
+
+
+  def rotate(self):
+    """ Starts a new segment, e.g. for a new race """
+    if self.stopped:
+      return
+    self.queue.put(time.strftime('race-%Y%m%d-%H%M%S', time.localtime()))
+
+
+  def close(self):
+    """ Writes what is queued, syncs and stops the writer thread """
+    self.queue.put(None)
+    self.thread.join()
+
+
+  def run(self):
+    """ Writer thread. Items are records (bytes), segment names (str) or None to stop. """
+    f = None
+    dirty = False # Written but not synced
+    last_sync = time.monotonic()
+    timeout = self.fsync if self.fsync > 0 else None
+    try:
+      while True:
+        try:
+          item = self.queue.get(timeout=timeout if dirty else None)
+        except queue.Empty: # Quiet: sync what was written
+          self.sync(f)
+          dirty = False
+          last_sync = time.monotonic()
+          continue
+        if isinstance(item, bytes):
+          if f is None:
+            continue
+          f.write(item)
+          dirty = True
+          if self.queue.empty(): # Hand over to the OS, no need to keep it in our buffer
+            f.flush()
+          if self.fsync >= 0 and time.monotonic() - last_sync >= self.fsync:
+            self.sync(f)
+            dirty = False
+            last_sync = time.monotonic()
+          continue
+        if f is not None:
+          self.sync(f)
+          dirty = False
+          f.close()
+          f = None
+        if item is None:
+          return
+        f = self.create(item)
+        f.write(Journal.header())
+    except Exception as e:
+      self.stopped = True # Before anything else is queued for nobody
+      self.logger.error('Journal stopped: {}'.format(e))
+      while True: # What is already queued
+        try:
+          self.queue.get_nowait()
+        except queue.Empty:
+          break
+    finally:
+      if f is not None:
+        f.close()
+
+
+  def create(self, name):
+    """ Creates a new segment file, never appends to an existing one """
+    path = os.path.join(self.directory, name + Journal.SUFFIX)
+    index = 1
+    while True:
+      try:
+        f = open(path, 'xb')
+        self.logger.info('Journal: {}'.format(path))
+        return f
+      except FileExistsError:
+        path = os.path.join(self.directory, '{}-{}{}'.format(name, index, Journal.SUFFIX))
+        index += 1
+
+
+  def sync(self, f):
+    f.flush()
+    if self.fsync >= 0:
+      os.fsync(f.fileno())
+
+
+class JournalReader:
+  """ Reads a journal segment through a memory map """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    if self.map[:len(Journal.MAGIC)] != Journal.MAGIC:
+      self.close()
+      raise ValueError('Not a journal: {}'.format(path))
+    # A record that was being written when the process stopped is ignored
+    self.count = (len(self.map) - Journal.HEADER_SIZE) // Journal.RECORD.size
+
+
+  def __len__(self):
+    return self.count
+
+
+  def __getitem__(self, index):
+    """ Returns (host_time, frame_type, device, uid, timer_value) """
+    if index < 0:
+      index += self.count
+    if index < 0 or index >= self.count:
+      raise IndexError(index)
+    return Journal.RECORD.unpack_from(self.map, Journal.HEADER_SIZE + index * Journal.RECORD.size)
+
+
+  def __iter__(self):
+    end = Journal.HEADER_SIZE + self.count * Journal.RECORD.size
+    view = memoryview(self.map)[Journal.HEADER_SIZE:end]
+    try:
+      yield from Journal.RECORD.iter_unpack(view)
+    finally:
+      view.release()
+
+
+  def packets(self):
+    """ Yields (host_time, frame) with frames in the same form as AioEasyLapDevice. Frames of other receivers than device 0 get a 'device' key with their index. """
+    for host_time, frame_type, device, uid, timer_value in self:
+      frame = Frame(frame_type, uid, timer_value)
+      if device:
+        frame[Journal.KEY_DEVICE] = device
+      yield host_time, frame
+
+
+  def close(self):
+    if isinstance(self.map, mmap.mmap):
+      self.map.close()
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,47 @@
+# Latency from reading a frame off the wire to handing it to the network.
+
+import time
+
+
+class LatencyMeter:
+  """ Keeps count/min/avg/max of latencies between two reports """
+
+  REPORT_INTERVAL = 10 # Seconds between reports
+
+  def __init__(self, report_interval = REPORT_INTERVAL):
+    self.report_interval = report_interval
+    self.last_report = time.monotonic()
+    self.reset()
+
+
+  def reset(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+
+  def add(self, seconds):
+    """ Adds one sample, in seconds """
+    self.count += 1
+    self.total += seconds
+    if self.min is None or seconds < self.min:
+      self.min = seconds
+    if self.max is None or seconds > self.max:
+      self.max = seconds
+
+
+  def due(self):
+    """ True if it is time for a report """
+    return time.monotonic() - self.last_report >= self.report_interval
+
+
+  def report(self):
+    """ Returns a summary of the samples since the last report and starts over """
+    self.last_report = time.monotonic()
+    if not self.count:
+      return 'no samples'
+    summary = 'n={} min={:.2f}ms avg={:.2f}ms max={:.2f}ms'.format(
+      self.count, self.min * 1000, self.total / self.count * 1000, self.max * 1000)
+    self.reset()
+    return summary
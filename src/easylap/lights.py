@@ -1,58 +1,147 @@
-import sys
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import backend
 from .base import Base
 
 # Lights on and off.
-
-try:
-  # These are available only on Raspberry Pi
-  import board
-  import busio
-  import digitalio
-  from adafruit_mcp230xx.mcp23017 import MCP23017
-except:
-  # For development on Mac
-  try:
-    import easylap.fake.board as board
-    import easylap.fake.busio as busio
-    import easylap.fake.digitalio as digitalio
-    from .fake.mcp23017 import MCP23017
-  except ImportError as e:
-    print('Cannot import: {} - exiting.'.format(e))
-    sys.exit(1)
+#
+# The state of the 16 pins is cached and written to the GPIOA/GPIOB port registers
+# in one I2C transaction, only when it changes. The writes run on a single worker
+# thread, in order, so a LIGHTS command never blocks the event loop. If several
+# values are waiting, only the latest one is written. The Adafruit libraries are imported
+# when the lights are created (fakes for development on Mac), see the backend module.
     
     
 class Lights(Base):
   
-  pins = []
-  
   def __init__(self, log_options):
     super().__init__('Lights', log_options)
+    board, busio, MCP23017 = backend.mcp23017()
     i2c = busio.I2C(board.SCL, board.SDA)
-    mcp = MCP23017(i2c)  # MCP23017
+    self.mcp = MCP23017(i2c)  # MCP23017
+    self.value = 0xFFFF # The latest value asked for
+    self.written = None # The value on the port
+    self.written_at = None # time.monotonic() right after the last port write
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Lights')
 
-    for i in range(0, 16):
-      pin = mcp.get_pin(i)
-      pin.switch_to_output(value=True)
-      self.pins.append(pin)
+    # All high, then all outputs (like switch_to_output(value=True) on every pin)
+    self.mcp.gpio = self.value
+    self.mcp.iodir = 0x0000
+    self.written = self.value
 
     
   def set(self, value):
     """ 
     Turns LEDs on or off. Do not use logging here: can be called after a signal was received.
+    Returns immediately, the port is written by the worker thread.
     
     :param value: bit-encoded     
+    :return: a future that is done when the value is on the port, with the result of write()
     """
     if value < 0 or value > 0xFFFF:
       raise RuntimeError('Value out of range')
-    for i in range(0, 16):
-      self.pins[i].value = value & (1<<i)
+    self.value = value
+    return self.executor.submit(self.write)
+
+
+  def write(self):
+    """ Worker thread: writes the latest value, if it changed. Returns time.monotonic() when the value on the port was written. """
+    value = self.value
+    if value != self.written:
+      self.mcp.gpio = value
+      self.written_at = time.monotonic()
+      self.written = value
+    return self.written_at
       
       
   def on(self):
     """ All lights on """
-    self.set(0xFFFF)
+    return self.set(0xFFFF)
     
     
   def off(self):
     """ All lights off """
-    self.set(0)
+    return self.set(0)
+
+
+  def close(self):
+    """ Waits for the pending writes """
+    self.executor.shutdown(wait=True)
+
+
+class StartSequence:
+  """
+  F1 start sequence: the 5 lights come on one by one, stay on for a (random) hold, then
+  all go out. Every step is scheduled with call_at at an absolute time from the start
+  on the loop's monotonic clock, so delays do not add up.
+  """
+
+  FIRST_PIN = 2 # On the 5 lights bar the first light is on pin 2
+  LIGHTS = 5
+  PROFILES = { # Seconds between lights, minimum and maximum hold before lights out
+    'F1': (1.0, 0.2, 3.0),
+    'FIXED': (1.0, 1.0, 1.0),
+    'QUICK': (0.5, 0.2, 1.0)
+  }
+
+  def __init__(self, lights, profile = 'F1', on_lights_out = None):
+    """
+    :param lights: the Lights
+    :param profile: a key of PROFILES
+    :param on_lights_out: called on the event loop with (time.monotonic() of lights out, this sequence)
+    """
+    if profile not in self.PROFILES:
+      raise RuntimeError('Unknown profile: {}'.format(profile))
+    self.lights = lights
+    self.profile = profile
+    self.on_lights_out = on_lights_out
+    self.handles = []
+    self.jitter = 0.0 # The latest a step ran after its time, seconds
+    self.hold = None
+
+
+  def start(self):
+    loop = asyncio.get_running_loop()
+    interval, min_hold, max_hold = self.PROFILES[self.profile]
+    self.hold = random.uniform(min_hold, max_hold)
+    start = loop.time()
+    self.lights.set(0)
+    for i in range(1, self.LIGHTS + 1):
+      value = ((1 << i) - 1) << self.FIRST_PIN
+      self.handles.append(loop.call_at(start + i * interval, self.step, start + i * interval, value))
+    lights_out = start + self.LIGHTS * interval + self.hold
+    self.handles.append(loop.call_at(lights_out, self.step, lights_out, 0))
+
+
+  def step(self, when, value):
+    loop = asyncio.get_running_loop()
+    self.jitter = max(self.jitter, loop.time() - when)
+    future = self.lights.set(value)
+    if value == 0:
+      self.handles = []
+      future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.done, f))
+
+
+  def done(self, future):
+    """ Called on the event loop when the lights out write is done """
+    if future.cancelled():
+      return
+    e = future.exception()
+    if e is not None: # The lights did not go out, or not now
+      self.lights.error('Cannot turn the lights out: %s', e)
+      return
+    if self.on_lights_out:
+      self.on_lights_out(future.result(), self)
+
+
+  def cancel(self):
+    """ Aborts the sequence, the lights stay as they are """
+    for handle in self.handles:
+      handle.cancel()
+    self.handles = []
+
+
+  def running(self):
+    return len(self.handles) > 0
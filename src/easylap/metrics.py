@@ -0,0 +1,226 @@
+# In-process counters and histograms for easylapd.
+#
+# Most counters are plain integer attributes that the components keep anyway (the frame
+# decoder, the device, the fan-out); Metrics reads them only when asked for a snapshot, so
+# they cost nothing when metrics are disabled. The extra work done only when metrics are
+# enabled is: one histogram update per forwarded packet, counting datagrams per client in
+# the fan-out, and a timer that measures the event loop lag.
+#
+# Snapshots are available as JSON with the STATS command of UnicastServer (to registered
+# clients only), and in the Prometheus text format from a small local HTTP endpoint
+# (easylapd --metrics-port). STATS lists at most STATS_CLIENTS clients in each per-client
+# map, those with the highest counts, so that the reply fits in one datagram.
+
+import asyncio
+import time
+from bisect import bisect_left
+
+
+class Histogram:
+  """ Counts samples in fixed buckets """
+
+  BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0) # Seconds
+
+  def __init__(self, buckets = BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+
+  def add(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+
+  def cumulative(self):
+    """ Returns [(upper bound, count of samples <= bound)], the last bound is None for +Inf """
+    total = 0
+    result = []
+    for bound, count in zip(self.buckets + (None,), self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+
+  def snapshot(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'max': self.max,
+      'buckets': {('+Inf' if bound is None else str(bound)): count for bound, count in self.cumulative()}
+    }
+
+
+class Metrics:
+  """ Collects the counters of a running service """
+
+  LAG_INTERVAL = 0.5 # Seconds between event loop lag samples
+  PREFIX = 'easylap_'
+  STATS_CLIENTS = 8 # Entries of each per-client map in STATS
+  GAUGES = frozenset(('clients', 'clients_multicast', 'depth', 'max_depth')) # The other values only grow
+
+  def __init__(self):
+    self.latency = Histogram() # From reading a frame to sending it
+    self.loop_lag = Histogram() # How late a timer fires
+    self.devices = []
+    self.queues = [] # Pipeline queues other than the device queues
+    self.server = None
+    self.clock = None
+    self.lag_handle = None
+    self.http = None
+    self.started = time.time()
+
+
+  def attach_device(self, device):
+    """ Starts reading the counters of a device. The device object is kept across reconnects. """
+    if device not in self.devices:
+      self.devices.append(device)
+
+
+  def attach_server(self, server):
+    self.server = server
+    server.metrics = self
+    server.fanout.client_sent = {}
+
+
+  def device_counters(self):
+    """ Returns the counters of all devices, added up """
+    counters = {}
+    for device in self.devices:
+      decoder = device.decoder
+      for key, value in (
+        ('bytes_read', decoder.bytes),
+        ('frames_decoded', decoder.frames),
+        ('garbage_bytes', decoder.garbage),
+        ('resyncs', decoder.resyncs),
+        ('frames_dropped', device.dropped)):
+        counters[key] = counters.get(key, 0) + value
+    return counters
+
+
+  def start(self):
+    """ Starts measuring the event loop lag """
+    loop = asyncio.get_running_loop()
+    expected = loop.time() + self.LAG_INTERVAL
+    def sample():
+      nonlocal expected
+      now = loop.time()
+      self.loop_lag.add(max(0.0, now - expected))
+      expected = now + self.LAG_INTERVAL
+      self.lag_handle = loop.call_at(expected, sample)
+    self.lag_handle = loop.call_at(expected, sample)
+
+
+  def stop(self):
+    if self.lag_handle:
+      self.lag_handle.cancel()
+      self.lag_handle = None
+    if self.http:
+      self.http.close()
+      self.http = None
+
+
+  def queue_snapshots(self):
+    """ Returns the depth and drop counters of each pipeline queue """
+    queues = [device.queue for device in self.devices] + self.queues
+    return {queue.name: queue.snapshot() for queue in queues}
+
+
+  def snapshot(self, max_clients = None):
+    """
+    Returns all counters and histograms as a dict.
+
+    :param max_clients: the number of clients in each per-client map, those with the highest counts, None for all
+    """
+    counters = self.device_counters()
+    clients = {}
+    client_errors = {}
+    server = self.server
+    if server:
+      fanout = server.fanout
+      counters['clients'] = len(server.clients)
+      counters['clients_expired'] = server.clients.expired
+      counters['clients_evicted'] = server.clients.evicted
+      counters['clients_failed'] = server.clients.failed
+      if server.multicast:
+        counters['clients_multicast'] = sum(1 for client in server.clients.values() if server.receives_multicast(client))
+      counters['packets'] = server.seq
+      counters['datagrams_sent'] = fanout.sent
+      counters['send_errors'] = fanout.errors
+      clients = {'{}:{}'.format(*addr): count for addr, count in (fanout.client_sent or {}).items()}
+      client_errors = {'{}:{}'.format(*client.addr): client.errors for client in server.clients.values() if client.errors}
+      if max_clients is not None:
+        clients = self.largest(clients, max_clients)
+        client_errors = self.largest(client_errors, max_clients)
+    return {
+      'uptime': time.time() - self.started,
+      'clock': self.clock.snapshot() if self.clock else None,
+      'counters': counters,
+      'clients': clients,
+      'client_errors': client_errors,
+      'queues': self.queue_snapshots(),
+      'latency': self.latency.snapshot(),
+      'loop_lag': self.loop_lag.snapshot()
+    }
+
+
+  @classmethod
+  def largest(cls, counts, count):
+    """ Returns the count entries of a dict with the largest values """
+    if len(counts) <= count:
+      return counts
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:count])
+
+
+  def metric_type(self, key):
+    return 'gauge' if key in self.GAUGES else 'counter'
+
+
+  def prometheus(self):
+    """ Returns the snapshot in the Prometheus text format """
+    snapshot = self.snapshot()
+    prefix = self.PREFIX
+    lines = ['# TYPE {}uptime_seconds gauge'.format(prefix), '{}uptime_seconds {}'.format(prefix, snapshot['uptime'])]
+    for key, value in snapshot['counters'].items():
+      lines.append('# TYPE {}{} {}'.format(prefix, key, self.metric_type(key)))
+      lines.append('{}{} {}'.format(prefix, key, value))
+    for name, key in (('client_datagrams_sent', 'clients'), ('client_send_errors', 'client_errors')):
+      if snapshot[key]:
+        lines.append('# TYPE {}{} counter'.format(prefix, name))
+      for client, count in snapshot[key].items():
+        lines.append('{}{}{{client="{}"}} {}'.format(prefix, name, client, count))
+    queues = snapshot['queues']
+    for key in next(iter(queues.values()), {}):
+      lines.append('# TYPE {}queue_{} {}'.format(prefix, key, self.metric_type(key)))
+      for queue, values in queues.items():
+        lines.append('{}queue_{}{{queue="{}"}} {}'.format(prefix, key, queue, values[key]))
+    for name, histogram in (('latency_seconds', self.latency), ('loop_lag_seconds', self.loop_lag)):
+      lines.append('# TYPE {}{} histogram'.format(prefix, name))
+      for bound, count in histogram.cumulative():
+        lines.append('{}{}_bucket{{le="{}"}} {}'.format(prefix, name, '+Inf' if bound is None else bound, count))
+      lines.append('{}{}_sum {}'.format(prefix, name, histogram.sum))
+      lines.append('{}{}_count {}'.format(prefix, name, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+  async def serve(self, port, host = '127.0.0.1'):
+    """ Serves the Prometheus text on http://host:port/ (any path) """
+    self.http = await asyncio.start_server(self.handle_http, host, port)
+
+
+  async def handle_http(self, reader, writer):
+    try:
+      await reader.readline() # Request line, anything goes
+      while (await reader.readline()).strip(): # Headers
+        pass
+      body = self.prometheus().encode()
+      writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' +
+        str(len(body)).encode() + b'\r\n\r\n' + body)
+      await writer.drain()
+    finally:
+      writer.close()
@@ -0,0 +1,104 @@
+# Bounded queues between the stages of easylapd:
+#
+#   reader thread + decoder -> [device queue] -> enrichment (clock, journal, race) -> [outgoing queue] -> encoder + fan-out
+#
+# A stage that stalls fills the queue in front of it instead of stalling the stages before
+# it; the reader thread never waits for the event loop, so the small CP2110 FIFO is read in
+# time. When a queue is full, the overflow policy applies: an item that may be dropped
+# (a timer packet, there is another one soon) is dropped, otherwise the oldest droppable
+# item in the queue makes room. Car packets and events are never dropped; if nothing can be
+# dropped the queue grows past its capacity and the overflow is counted.
+
+import asyncio
+from collections import deque
+
+from .decoder import FrameDecoder
+
+
+def is_timer_frame(item):
+  """ Drop policy of the device queue: items are Frame objects """
+  return item is not None and item.type == FrameDecoder.TIMER
+
+
+def is_timer_packet(item):
+  """ Drop policy of the outgoing queue: items are (packet, time read) """
+  packet = item[0]
+  return not packet.get('uid') and 'type' not in packet
+
+
+class BoundedQueue:
+  """ FIFO with a capacity and a drop policy, for one consumer on the event loop """
+
+  CAPACITY = 256
+
+  def __init__(self, name, capacity = CAPACITY, droppable = None):
+    """
+    :param name: the name in the metrics
+    :param capacity: the number of items before the drop policy applies
+    :param droppable: function that returns True for items that may be dropped, None for none
+    """
+    self.name = name
+    self.capacity = capacity
+    self.droppable = droppable
+    self.items = deque()
+    self.waiter = None
+    self.dropped = 0 # Items dropped by the policy
+    self.overflow = 0 # Items queued past the capacity because nothing could be dropped
+    self.max_depth = 0
+    self.count = 0 # Items queued
+
+
+  def __len__(self):
+    return len(self.items)
+
+
+  def put(self, item):
+    """ Queues an item without waiting, returns False if the item was dropped. Call on the event loop. """
+    items = self.items
+    if len(items) >= self.capacity:
+      droppable = self.droppable
+      if droppable and droppable(item):
+        self.dropped += 1
+        return False
+      if not self.make_room():
+        self.overflow += 1
+    items.append(item)
+    self.count += 1
+    if len(items) > self.max_depth:
+      self.max_depth = len(items)
+    waiter = self.waiter
+    if waiter is not None and not waiter.done():
+      waiter.set_result(None)
+    return True
+
+
+  def make_room(self):
+    """ Drops the oldest droppable item, returns False if there is none """
+    droppable = self.droppable
+    if droppable:
+      for i, queued in enumerate(self.items):
+        if droppable(queued):
+          del self.items[i]
+          self.dropped += 1
+          return True
+    return False
+
+
+  async def get(self):
+    """ Waits for an item """
+    items = self.items
+    while not items:
+      self.waiter = asyncio.get_running_loop().create_future()
+      try:
+        await self.waiter
+      finally:
+        self.waiter = None
+    return items.popleft()
+
+
+  def clear(self):
+    self.items.clear()
+
+
+  def snapshot(self):
+    return {'depth': len(self.items), 'max_depth': self.max_depth, 'queued': self.count, 'dropped': self.dropped, 'overflow': self.overflow}
@@ -0,0 +1,132 @@
+# Lap computation on the server.
+#
+# Keeps, per transponder uid, the last crossing, lap count, last/best/average lap and the
+# position in the standings, so that clients do not have to recompute them. Each crossing
+# is O(1) for the lap times and O(log n) to find the new position in the standings (a
+# sorted list of (-laps, crossed, uid) keys).
+#
+# Times are in device timer ticks. The 32-bit device timer rolls over; every frame,
+# including the periodic timer packets, advances an unwrapped race clock so that crossings
+# can be compared across a rollover. When the device is reconnected its timer may have
+# restarted; resync() continues the race clock from the next frame without counting the
+# jump. The lap each car was on is then of unknown length: its next crossing starts a new
+# lap without counting one.
+
+from bisect import bisect_left, insort
+
+
+class Racer:
+  """ Lap data of one transponder """
+
+  __slots__ = ('uid', 'crossed', 'laps', 'last_lap', 'best_lap', 'total', 'epoch')
+
+  def __init__(self, uid, crossed, epoch = 0):
+    self.uid = uid
+    self.epoch = epoch # Race.epoch at the last crossing
+    self.crossed = crossed # Unwrapped race clock at the last crossing
+    self.laps = 0
+    self.last_lap = None
+    self.best_lap = None
+    self.total = 0 # Sum of all lap times
+
+
+  def key(self):
+    """ Sort key in the standings: more laps first, then whoever got there first """
+    return (-self.laps, self.crossed, self.uid)
+
+
+  def average_lap(self):
+    return self.total / self.laps if self.laps else None
+
+
+class Race:
+  """ Race state computed from device frames """
+
+  TYPE = 'lap' # Value of 'type' in lap events
+  KEY_TIME = 'time'
+  KEY_UID = 'uid'
+  MASK = 0xFFFFFFFF # The device timer is 32-bit
+
+  def __init__(self, min_lap = 0):
+    """
+    :param min_lap: crossings closer than this many ticks to the previous one are ignored
+    """
+    self.min_lap = min_lap
+    self.reset()
+
+
+  def reset(self):
+    """ Starts a new race """
+    self.racers = {}
+    self.standings = []
+    self.clock = 0 # Unwrapped device time
+    self.raw = None # Last raw timer value
+    self.epoch = 0 # Resyncs
+
+
+  def resync(self):
+    """ Takes the next timer value as is, e.g. after the device was reconnected and its timer restarted """
+    self.raw = None
+    self.epoch += 1
+
+
+  def tick(self, timer_value):
+    """ Advances the race clock, handling the 32-bit rollover """
+    if self.raw is not None:
+      self.clock += (timer_value - self.raw) & self.MASK
+    self.raw = timer_value
+    return self.clock
+
+
+  def update(self, packet):
+    """
+    Updates the race from a device packet.
+
+    :param packet: a dict, e.g. {'time': timer_value, 'uid': uid}. uid 0 is a timer packet.
+    :return: a lap event (a dict) for a car packet, None otherwise
+    """
+    now = self.tick(packet[self.KEY_TIME])
+    uid = packet[self.KEY_UID]
+    if not uid:
+      return None
+    return self.cross(uid, now, packet[self.KEY_TIME])
+
+
+  def cross(self, uid, now, timer_value):
+    racer = self.racers.get(uid)
+    if racer is None: # First crossing starts the first lap
+      racer = Racer(uid, now, self.epoch)
+      self.racers[uid] = racer
+    elif racer.epoch != self.epoch: # First crossing since a resync, the lap is not timed
+      del self.standings[bisect_left(self.standings, racer.key())]
+      racer.crossed = now
+      racer.epoch = self.epoch
+    else:
+      lap = now - racer.crossed
+      if lap < self.min_lap:
+        return None
+      del self.standings[bisect_left(self.standings, racer.key())]
+      racer.crossed = now
+      racer.laps += 1
+      racer.last_lap = lap
+      racer.total += lap
+      if racer.best_lap is None or lap < racer.best_lap:
+        racer.best_lap = lap
+    key = racer.key()
+    insort(self.standings, key)
+    return {
+      'type': self.TYPE,
+      self.KEY_UID: uid,
+      self.KEY_TIME: timer_value,
+      'lap': racer.laps,
+      'last': racer.last_lap,
+      'best': racer.best_lap,
+      'average': racer.average_lap(),
+      'position': bisect_left(self.standings, key) + 1
+    }
+
+
+  def positions(self):
+    """ Returns the racers in the order of the standings """
+    racers = self.racers
+    return [racers[uid] for laps, crossed, uid in self.standings]
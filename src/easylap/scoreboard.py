@@ -0,0 +1,112 @@
+# Standings for track-side displays and spectators.
+#
+# A display wants the table, not every crossing. Scoreboard looks at the race standings at
+# a fixed rate and publishes only the rows that changed since the last tick, so the traffic
+# depends on the tick rate and not on the number of cars crossing. Every table has a
+# version; a delta applies to the version in 'base'. A full table (a keyframe) is published
+# every KEYFRAME seconds and after a race reset, so a display that joins or misses a delta
+# catches up:
+#
+#   {"type": "scoreboard", "version": 12, "base": 11, "rows": [[position, uid, laps, last, best], ...], "part": 1, "parts": 1}
+#   {"type": "scoreboard", "version": 13, "full": true, "rows": [...], "part": 1, "parts": 2}
+#
+# A delta also lists the uids that left the table in 'removed'. Lap times are in device
+# timer ticks. Clients get the scoreboard with 'HELLO types=scoreboard' (see
+# UnicastServer.publish); it is not part of the packet sequence.
+
+import asyncio
+
+
+class Scoreboard:
+  """ Publishes the race standings as versioned deltas """
+
+  TYPE = 'scoreboard'
+  RATE = 5 # Ticks per second
+  KEYFRAME = 5.0 # Seconds between full tables
+  ROWS_PER_DATAGRAM = 32 # Fits in Fanout.MAX_DATAGRAM
+
+  def __init__(self, race, publish, rate = RATE, keyframe = KEYFRAME):
+    """
+    :param race: the Race
+    :param publish: called with each packet
+    :param rate: ticks per second
+    :param keyframe: seconds between full tables
+    :raise ValueError: if rate or keyframe is not a positive number
+    """
+    if not 0 < rate < float('inf') or not 0 < keyframe < float('inf'):
+      raise ValueError('Bad scoreboard rate or keyframe: {}, {}'.format(rate, keyframe))
+    self.race = race
+    self.publish = publish
+    self.interval = 1 / rate
+    self.keyframe = keyframe
+    self.version = 0
+    self.rows = {} # uid: the row in the last table published
+    self.keyframe_at = None # loop.time() of the next keyframe, None for now
+    self.handle = None
+    self.deltas = 0 # Packets published
+    self.keyframes = 0
+
+
+  def start(self):
+    """ Starts ticking on the running loop """
+    loop = asyncio.get_running_loop()
+    expected = loop.time()
+    def tick():
+      nonlocal expected
+      self.tick(loop.time())
+      expected += self.interval
+      self.handle = loop.call_at(max(expected, loop.time()), tick) # Absolute times, delays do not add up
+    self.handle = loop.call_soon(tick)
+
+
+  def stop(self):
+    if self.handle:
+      self.handle.cancel()
+      self.handle = None
+
+
+  def reset(self):
+    """ Publishes a full table at the next tick, e.g. after a race reset """
+    self.keyframe_at = None
+
+
+  def table(self):
+    """ Returns the current standings as {uid: [position, uid, laps, last, best]} """
+    return {racer.uid: [position, racer.uid, racer.laps, racer.last_lap, racer.best_lap]
+      for position, racer in enumerate(self.race.positions(), 1)}
+
+
+  def tick(self, now):
+    """ Publishes what changed since the last tick """
+    rows = self.table()
+    previous = self.rows
+    if self.keyframe_at is None or now >= self.keyframe_at:
+      self.version += 1
+      self.keyframe_at = now + self.keyframe
+      self.keyframes += 1
+      self.send({'version': self.version, 'full': True}, list(rows.values()))
+    else:
+      changed = [row for uid, row in rows.items() if previous.get(uid) != row]
+      removed = [uid for uid in previous if uid not in rows]
+      if not changed and not removed:
+        return
+      self.version += 1
+      self.deltas += 1
+      header = {'version': self.version, 'base': self.version - 1}
+      if removed:
+        header['removed'] = removed
+      self.send(header, changed)
+    self.rows = rows
+
+
+  def send(self, header, rows):
+    """ Publishes the rows in as many packets as needed """
+    size = self.ROWS_PER_DATAGRAM
+    parts = max(1, -(-len(rows) // size))
+    for part in range(parts):
+      packet = {'type': self.TYPE}
+      packet.update(header)
+      packet['rows'] = rows[part * size:(part + 1) * size]
+      packet['part'] = part + 1
+      packet['parts'] = parts
+      self.publish(packet)
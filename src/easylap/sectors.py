@@ -0,0 +1,53 @@
+# Sector times from several receivers.
+#
+# The receivers are listed in track order, the first one at start/finish. Sector N is the
+# part of the track from receiver N-1 to receiver N (the last one back to start/finish).
+# Times are in seconds of host time, because each receiver has its own timer.
+
+class Sectors:
+  """ Sector times of each car """
+
+  TYPE = 'sector'
+  KEY_UID = 'uid'
+  KEY_DEVICE = 'device'
+
+  def __init__(self, order):
+    """
+    :param order: the device names in track order, start/finish first
+    """
+    self.order = list(order)
+    self.index = {name: i for i, name in enumerate(self.order)}
+    self.last = {} # uid: (device index, host time of the crossing)
+
+
+  def reset(self):
+    self.last.clear()
+
+
+  def update(self, packet, when):
+    """
+    Adds a crossing.
+
+    :param packet: a device packet with 'uid' and 'device'
+    :param when: host time of the crossing, seconds
+    :return: a sector event, None if the packet does not complete a sector
+    """
+    uid = packet.get(self.KEY_UID)
+    i = self.index.get(packet.get(self.KEY_DEVICE))
+    if not uid or i is None:
+      return None
+    previous = self.last.get(uid)
+    self.last[uid] = (i, when)
+    if previous is None:
+      return None
+    j, then = previous
+    if i != (j + 1) % len(self.order): # Same receiver again or a split was missed
+      return None
+    return {
+      'type': self.TYPE,
+      'uid': uid,
+      'sector': j + 1,
+      'from': self.order[j],
+      'to': self.order[i],
+      'time': when - then
+    }
@@ -2,31 +2,132 @@
 import argparse
 import asyncio
 import logging
-import json
 import sys
+import time
 import traceback
 
 from concurrent.futures._base import CancelledError
 from signal import SIGHUP, SIGINT, SIGTERM
 
+IMPORTED = time.perf_counter() # For the startup timings, see CreateService.mark()
+
+from . import backend
+from .aggregator import DeviceAggregator
 from .aiodevice import AioEasyLapDevice
 from .base import Base, LogOptions
-from .device import EasyLapDeviceException
-from .lights import Lights
+from .clients import ClientRegistry
+from .clock import ClockSync
+from .journal import Journal, JournalReader, JournalWriter
+from .latency import LatencyMeter
+from .lights import Lights, StartSequence
+from .metrics import Metrics
+from .pipeline import BoundedQueue, is_timer_packet
+from .race import Race
+from .scoreboard import Scoreboard
+from .sectors import Sectors
+from .session import Session
+from .supervisor import DeviceSupervisor
 from .unicast_server import UnicastServer
 
 
 class CreateService(Base):
   
   LIGHTS = 'LIGHTS'
+  RACE = 'RACE'
+  START = 'START'
+  
+  server = None
+  sequence = None # The running start sequence
+  clock = None # Device timer to host time model
+  annotate = False # Add host time estimates to the packets
+  race = None # Lap computation, if enabled
+  journal = None # Journal writer, if enabled
+  scoreboard = None # Publishes the standings, if enabled
+  metrics = None # Counters and histograms, if enabled
+  supervisor = None # Keeps the device connected
+  aggregator = None # Merges several devices, if more than one
+  session = None # Sent to clients that join late
+  sectors = None # Sector times, if enabled
+  WAITING = (1<<3)+(1<<5) # Waiting lights. On the 5 lights bar the first light start at pin=2 !!!
+  
+  lights = None # Created in a worker thread, None until then
+  waiting_handle = None # Sets the waiting lights after the started lights
+  startup = None # Label: time.perf_counter(), in order, until the first packet is sent
+  outgoing = None # Packets waiting for the send stage, see the pipeline module
+  sender = None # The send stage task
+  sending = None # time.monotonic() when the packet being sent was read, None for events
 
   
-  def __init__(self, args):
+  def __init__(self, args, run = True, started = None):
+    """
+    :param args: the command line arguments
+    :param run: run the service until it is stopped, False only parses the arguments
+    :param started: time.perf_counter() when the process started, for the startup timings
+    """
+    self.started = started if started is not None else IMPORTED
+    self.startup = {'imports': IMPORTED}
     
     parser = argparse.ArgumentParser(description='EasyLap service')
     parser.add_argument('-d', '--daemon', help='run as daemon', required=False, default=False, action='store_true')
     parser.add_argument('-v', '--verbose', help='show detailed info', required=False, default=False, action='store_true')
+    parser.add_argument('--poll', help='poll the device on the event loop instead of using a reader thread', required=False, default=False, action='store_true')
+    parser.add_argument('--coalesce', help='milliseconds to collect packets into one datagram per client, 0 to send immediately', required=False, default=0, type=float)
+    parser.add_argument('--laps', help='compute laps and standings and send lap events to clients', required=False, default=False, action='store_true')
+    parser.add_argument('--min-lap', help='ignore crossings closer than this many device ticks', required=False, default=0, type=int)
+    parser.add_argument('--scoreboard', help='publish the standings to clients that subscribe to scoreboard this many times per second, implies --laps', required=False, default=0, type=float)
+    parser.add_argument('--scoreboard-keyframe', help='seconds between full scoreboard tables', required=False, default=Scoreboard.KEYFRAME, type=float)
+    parser.add_argument('--journal', help='append every frame to a journal in this directory', required=False, default=None)
+    parser.add_argument('--journal-fsync', help='seconds between journal fsync calls, 0 after every frame, negative never', required=False, default=JournalWriter.FSYNC_INTERVAL, type=float)
+    parser.add_argument('--replay', help='replay a journal file or directory to clients instead of reading the device', required=False, default=None)
+    parser.add_argument('--replay-speed', help='replay speed, 1 is real time, 0 is as fast as possible', required=False, default=1, type=float)
+    parser.add_argument('--metrics', help='keep counters, answer the STATS command', required=False, default=False, action='store_true')
+    parser.add_argument('--metrics-port', help='serve the counters in the Prometheus format on this local port, implies --metrics', required=False, default=None, type=int)
+    parser.add_argument('--host-time', help='add the estimated host time of the device timer value to every packet', required=False, default=False, action='store_true')
+    parser.add_argument('--ticks', help='device timer ticks per second', required=False, default=ClockSync.TICKS_PER_SECOND, type=int)
+    parser.add_argument('--max-clients', help='maximum number of registered clients', required=False, default=ClientRegistry.MAX_CLIENTS, type=int)
+    parser.add_argument('--max-per-host', help='maximum number of registered clients from one IP address', required=False, default=ClientRegistry.MAX_PER_HOST, type=int)
+    parser.add_argument('--client-timeout', help='seconds without a HELLO before a client is removed', required=False, default=ClientRegistry.TIMEOUT, type=float)
+    parser.add_argument('--max-failures', help='datagrams that cannot be delivered to a client since its last HELLO before it is removed, 0 to wait for the timeout', required=False, default=ClientRegistry.MAX_FAILURES, type=int)
+    parser.add_argument('--device', help='a device to read: [name=]serial:NUMBER, [name=]path:PATH or all. Repeat for more devices, in track order with start/finish first.', required=False, default=[], action='append')
+    parser.add_argument('--sectors', help='send sector times, needs more than one --device', required=False, default=False, action='store_true')
+    parser.add_argument('--merge-window', help='milliseconds to wait for the crossings of the other devices', required=False, default=DeviceAggregator.WINDOW * 1000, type=float)
+    parser.add_argument('--multicast', help='also send every packet once to this multicast GROUP[:PORT], clients that receive it are not sent unicast', required=False, default=None)
+    parser.add_argument('--queue-size', help='packets waiting between two stages before timer packets are dropped', required=False, default=BoundedQueue.CAPACITY, type=int)
+    parser.add_argument('--uvloop', help='run on uvloop, if installed', required=False, default=False, action='store_true')
     parsed_args = parser.parse_args(args)
+    if not 0 <= parsed_args.scoreboard < float('inf') or not 0 < parsed_args.scoreboard_keyframe < float('inf'):
+      parser.error('--scoreboard must be 0 or a positive number, --scoreboard-keyframe a positive number')
+    self.uvloop = parsed_args.uvloop
+    self.queue_size = parsed_args.queue_size
+    self.outgoing = BoundedQueue('outgoing', self.queue_size, is_timer_packet)
+    self.device_specs = parsed_args.device
+    self.merge_window = parsed_args.merge_window / 1000
+    self.sector_times = parsed_args.sectors
+    self.max_clients = parsed_args.max_clients
+    self.max_per_host = parsed_args.max_per_host
+    self.client_timeout = parsed_args.client_timeout
+    self.max_failures = parsed_args.max_failures
+    self.multicast = None
+    if parsed_args.multicast:
+      group, _, port = parsed_args.multicast.partition(':')
+      self.multicast = (group, int(port) if port else UnicastServer.MULTICAST_PORT)
+    self.threaded = not parsed_args.poll
+    self.ticks = parsed_args.ticks
+    self.clock = ClockSync(ticks_per_second = self.ticks)
+    self.annotate = parsed_args.host_time
+    self.metrics_port = parsed_args.metrics_port
+    if parsed_args.metrics or parsed_args.metrics_port:
+      self.metrics = Metrics()
+      self.metrics.queues.append(self.outgoing)
+    self.journal_dir = parsed_args.journal
+    self.journal_fsync = parsed_args.journal_fsync
+    self.replay_path = parsed_args.replay
+    self.replay_speed = parsed_args.replay_speed
+    self.coalesce = parsed_args.coalesce / 1000
+    if parsed_args.laps or parsed_args.scoreboard:
+      self.race = Race(min_lap = parsed_args.min_lap)
+    self.scoreboard_rate = parsed_args.scoreboard
+    self.scoreboard_keyframe = parsed_args.scoreboard_keyframe
     log_options = LogOptions()
     if parsed_args.daemon:
       log_options.syslog = True
@@ -38,15 +139,22 @@ class CreateService(Base):
       log_options.log_level = logging.DEBUG
     
     super().__init__('CreateService', log_options)
-    main_task = asyncio.ensure_future(self.main())
-    loop = asyncio.get_event_loop()
-    # for signal in [SIGINT, SIGTERM]:
-    #       loop.add_signal_handler(signal, main_task.cancel)
+    self.mark('arguments')
+    if run:
+      self.run()
+
+
+  def run(self):
+    """ Runs the service on a new event loop until it is stopped """
+    loop = self.new_event_loop()
+    asyncio.set_event_loop(loop)
+    self.mark('event loop')
+    main_task = loop.create_task(self.main())
     
     signals = (SIGHUP, SIGTERM, SIGINT)
     for s in signals:
         loop.add_signal_handler(
-            s, lambda s=s: asyncio.create_task(self.shutdown(s, loop)))
+            s, lambda s=s: loop.create_task(self.shutdown(s, loop)))
     
     try:
       loop.run_until_complete(main_task)  
@@ -54,6 +162,33 @@ class CreateService(Base):
       self.info('Done')
 
 
+  def new_event_loop(self):
+    if self.uvloop:
+      try:
+        import uvloop
+        return uvloop.new_event_loop()
+      except ImportError:
+        self.error('uvloop is not installed, using asyncio')
+    return asyncio.new_event_loop()
+
+
+  def mark(self, label):
+    """ Records a startup step, the first time only """
+    if self.startup is not None and label not in self.startup:
+      self.startup[label] = time.perf_counter()
+
+
+  def report_startup(self):
+    """ Logs the startup timings, in milliseconds since the process started. Called once, after the first packet. """
+    self.mark('first packet')
+    startup, self.startup = self.startup, None
+    if not self.logger.isEnabledFor(logging.DEBUG):
+      return
+    steps = ', '.join('{} {:.1f}'.format(label, (when - self.started) * 1000) for label, when in startup.items())
+    imports = ', '.join('{} {:.1f}'.format(name, seconds * 1000) for name, seconds in backend.timings.items())
+    self.debug('Startup (ms): %s; backend imports (ms): %s', steps, imports or 'none')
+
+
   async def shutdown(self, signal, loop):
     """Cleanup tasks tied to the service's shutdown."""
     logging.info(f"Received exit signal {signal.name}...")
@@ -68,43 +203,261 @@ class CreateService(Base):
 
   def handle_message(self, lights, message):
     """ Cannot be async because it is called from a callback in server. Should be handled quickly or should create an asynchronous task. """
+    if message.startswith(self.LIGHTS) or message.startswith(self.START):
+      if not lights:
+        self.info('Lights not ready, ignoring: %s', message)
+        return
+      if self.waiting_handle:
+        self.waiting_handle.cancel() # Too late for the waiting lights
+        self.waiting_handle = None
     if message.startswith(self.LIGHTS):
       value = message[len(self.LIGHTS):].strip()
+      if self.sequence:
+        self.sequence.cancel() # Manual control wins
       if value == 'ON':
         lights.on()
       elif value == 'OFF':
         lights.off()
       else:
         lights.set(int(value))
+    elif message.startswith(self.RACE):
+      value = message[len(self.RACE):].strip()
+      if value == 'RESET':
+        if self.race:
+          self.race.reset()
+        if self.sectors:
+          self.sectors.reset()
+        if self.session:
+          self.session.reset()
+        if self.scoreboard:
+          self.scoreboard.reset()
+        if self.journal:
+          self.journal.rotate() # One segment per race
+    elif message.startswith(self.START):
+      value = message[len(self.START):].strip().upper()
+      if self.sequence:
+        self.sequence.cancel()
+      if value != 'ABORT':
+        self.sequence = StartSequence(lights, value or 'F1', self.lights_out)
+        self.sequence.start()
+
+
+  def lights_out(self, when, sequence):
+    """ Tells the clients when the lights went out, in host time and in device timer ticks """
+    self.info('Lights out (%s, hold %.3fs, jitter %.1fms)', sequence.profile, sequence.hold, sequence.jitter * 1000)
+    event = {'type': 'start', 'profile': sequence.profile, ClockSync.KEY_HOST_TIME: time.time() - (time.monotonic() - when)}
+    timer_value = self.clock.ticks_at(when)
+    if timer_value is not None:
+      event['time'] = timer_value
+      event[ClockSync.KEY_HOST_ERROR] = self.clock.error()
+    self.outgoing.put((event, None))
   
   
+  def device_state(self, state, name = None):
+    """ Tells the clients when a device is connected or disconnected """
+    if state == DeviceSupervisor.CONNECTED:
+      self.mark('device')
+      if not name:
+        self.clock.reset() # The device may have been power cycled
+      if self.race and (not name or name == next(iter(self.aggregator.devices))): # Laps are counted by the first device
+        self.race.resync()
+    event = {'type': 'device', 'state': state, ClockSync.KEY_HOST_TIME: time.time()}
+    if name:
+      event[DeviceAggregator.KEY_DEVICE] = name
+    self.outgoing.put((event, None))
+
+
+  async def replay(self, server):
+    """ Sends the packets of a journal to the clients, at the original pace times the replay speed """
+    while not server.clients: # Wait for someone to replay to
+      await asyncio.sleep(1)
+    for path in Journal.segments(self.replay_path):
+      self.info('Replaying: {}'.format(path))
+      with JournalReader(path) as reader:
+        previous = None
+        for host_time, packet in reader.packets():
+          if previous is not None and self.replay_speed > 0:
+            await asyncio.sleep(max(0, host_time - previous) / self.replay_speed)
+          else:
+            await asyncio.sleep(0)
+          previous = host_time
+          await server.send_packet(packet)
+          if self.race and Journal.KEY_DEVICE not in packet: # Laps from start/finish only
+            event = self.race.update(packet)
+            if event:
+              await server.send_packet(event)
+    self.info('Replay done')
+
+
+  async def forward(self, easylap, server, latency):
+    """ Queues the packets read from a device for the send stage. Returns when the device stops. """
+    async for frame in easylap.receive():
+      if not frame.uid: # Timer packet
+        self.clock.add(frame.time, frame.received_at)
+      self.process(frame, frame.received_at, self.clock)
+      await asyncio.sleep(0) # Let the send stage run
+
+
+  async def forward_merged(self, aggregator, server, latency):
+    """ Queues the packets of several devices for the send stage, in crossing order. Laps are counted by the first device. """
+    indexes = {name: index for index, name in enumerate(aggregator.devices)} # For the journal, 0 counts laps
+    async for name, packet, when, received_at in aggregator.receive():
+      self.process(packet, received_at, aggregator.clocks[name], indexes[name])
+      if self.sectors:
+        event = self.sectors.update(packet, when)
+        if event:
+          self.outgoing.put((event, None))
+      await asyncio.sleep(0) # Let the send stage run
+
+
+  def process(self, packet, received_at, clock, device = 0):
+    """ Enrichment stage: journals a device packet, queues it and the lap event it makes for the send stage. Laps are counted by device 0. """
+    if self.journal:
+      self.journal.write(packet, device = device)
+    if self.annotate:
+      clock.annotate(packet, packet.time)
+    self.outgoing.put((packet, received_at))
+    if self.race and not device:
+      event = self.race.update(packet)
+      if event:
+        self.outgoing.put((event, None))
+
+
+  def start_sender(self, server, latency):
+    """ Starts the send stage, if not running """
+    if self.sender is None or self.sender.done():
+      self.sender = asyncio.ensure_future(self.send_stage(server, latency))
+
+
+  async def send_stage(self, server, latency):
+    """ Encodes and sends the queued packets, runs until cancelled """
+    outgoing = self.outgoing
+    metrics = self.metrics
+    while True:
+      packet, received_at = await outgoing.get()
+      self.sending = received_at
+      try:
+        await server.send_packet(packet)
+      except CancelledError:
+        raise
+      except Exception: # One bad packet must not stop the forwarding
+        self.error('Cannot send %r: %s', packet, traceback.format_exc())
+        continue
+      if received_at is None: # An event
+        continue
+      delay = time.monotonic() - received_at
+      latency.add(delay)
+      if metrics:
+        metrics.latency.add(delay)
+      if latency.due():
+        self.debug('Latency: %s, outgoing queue: %s', latency.report(), outgoing.snapshot())
+      if self.startup is not None:
+        self.report_startup()
+
+
+  def create_devices(self):
+    """ Returns the AioEasyLapDevice objects selected with --device, not opened """
+    devices = []
+    for spec in self.device_specs:
+      if spec == 'all':
+        found = AioEasyLapDevice.enumerate()
+        self.info('Found %s devices', len(found))
+        for i, info in enumerate(found):
+          devices.append(AioEasyLapDevice(log_options=self.log_options, threaded=self.threaded, queue_size=self.queue_size, connect=False,
+            serial=info['serial'], path=None if info['serial'] else info['path'], name=info['serial'] or 'device{}'.format(i + 1)))
+        continue
+      name, _, selector = spec.rpartition('=')
+      kind, _, value = selector.partition(':')
+      if kind not in ('serial', 'path') or not value:
+        raise ValueError('Bad device: {}'.format(spec))
+      devices.append(AioEasyLapDevice(log_options=self.log_options, threaded=self.threaded, queue_size=self.queue_size, connect=False,
+        name=name or None, **{kind: value if kind == 'serial' else value.encode()}))
+    return devices
+
+
+  def lights_ready(self, future):
+    """ Called on the event loop when the lights are created """
+    try:
+      self.lights = future.result()
+    except Exception as e:
+      self.error('Cannot create lights: %s', e)
+      return
+    self.mark('lights')
+    if self.session:
+      self.session.lights = self.lights
+    self.lights.on() # Started
+    self.waiting_handle = asyncio.get_running_loop().call_later(1, self.lights.set, self.WAITING)
+
+
+  async def register(self, server):
+    """ Advertises the service, clients that know the address do not have to wait for this """
+    try:
+      await server.register_service()
+      self.mark('mDNS')
+    except CancelledError:
+      raise
+    except Exception:
+      self.error('Cannot register service: %s', traceback.format_exc())
+
+
   async def main(self):
     self.debug("main")
     
-    lights = None
+    loop = asyncio.get_running_loop()
+    registration = None
     
     try:
-      lights = Lights(log_options = self.log_options)
-      lights.on() # Started
-      server = UnicastServer(log_options=self.log_options, command_handler = lambda message: self.handle_message(lights, message))
+      # The I2C libraries are slow to import and to set up, the device and the clients do not wait for them
+      loop.run_in_executor(None, Lights, self.log_options).add_done_callback(self.lights_ready)
+      server = UnicastServer(log_options=self.log_options, command_handler = lambda message: self.handle_message(self.lights, message), coalesce = self.coalesce, max_clients = self.max_clients,
+        client_timeout = self.client_timeout, max_failures = self.max_failures, multicast = self.multicast, max_per_host = self.max_per_host)
+      self.server = server
+      self.session = server.session = Session()
      
       if not await server.create_endpoint():
         self.logger.error('Could not create endpoint, exiting')
         sys.exit(1)
-      await server.register_service()
+      self.mark('endpoint')
+      latency = LatencyMeter() # From reading a frame to sending it to all clients
+      self.start_sender(server, latency) # Before the replay and the devices, events are sent from now on
+      registration = asyncio.ensure_future(self.register(server)) # mDNS probing takes a while
+      if self.metrics:
+        self.metrics.attach_server(server)
+        self.metrics.clock = self.clock
+        self.metrics.start()
+        if self.metrics_port:
+          await self.metrics.serve(self.metrics_port)
       
-      await asyncio.sleep(1)
-      lights.set((1<<3)+(1<<5)) # Waiting. On the 5 lights bar the first light start at pin=2 !!!
+      if self.scoreboard_rate:
+        self.scoreboard = Scoreboard(self.race, server.publish, self.scoreboard_rate, self.scoreboard_keyframe)
+        self.scoreboard.start()
+
+      if self.replay_path:
+        await self.replay(server)
+        return
+      if self.journal_dir:
+        self.journal = JournalWriter(self.journal_dir, fsync = self.journal_fsync, log_options = self.log_options)
   
-      while True: # Do not let a EasyLapDeviceException stop this service
-        try:
-          await asyncio.sleep(1)
-          easylap = AioEasyLapDevice(log_options=self.log_options) # May not be connected
-          async for packet in easylap.receive():
-            await server.send(json.dumps(packet).encode())
-            await asyncio.sleep(0)      
-        except EasyLapDeviceException as e:
-          self.logger.debug('Device error: {}'.format(e.wrapped))
+      devices = self.create_devices()
+      if len(devices) > 1:
+        for easylap in devices:
+          if self.metrics:
+            self.metrics.attach_device(easylap)
+        self.aggregator = DeviceAggregator(devices, self.merge_window, lambda name, state: self.device_state(state, name), log_options=self.log_options,
+          ticks_per_second=self.ticks)
+        self.clock = self.aggregator.clocks[devices[0].name] # For the start sequence
+        self.session.finish = devices[0].name # Crossings at start/finish only
+        if self.metrics:
+          self.metrics.clock = self.clock
+        if self.sector_times:
+          self.sectors = Sectors(self.aggregator.devices)
+        await self.forward_merged(self.aggregator, server, latency) # Device errors do not stop this service
+        return
+      easylap = devices[0] if devices else AioEasyLapDevice(log_options=self.log_options, threaded=self.threaded, queue_size=self.queue_size, connect=False)
+      if self.metrics:
+        self.metrics.attach_device(easylap)
+      self.supervisor = DeviceSupervisor(easylap, self.device_state, log_options=self.log_options)
+      await self.supervisor.run(lambda easylap: self.forward(easylap, server, latency)) # Device errors do not stop this service
 
     except CancelledError:
       pass
@@ -112,7 +465,19 @@ class CreateService(Base):
       self.error(traceback.format_exc())
     finally:
       try:
-        lights.off()
+        if registration:
+          registration.cancel()
+        if self.sender:
+          self.sender.cancel()
+        if self.scoreboard:
+          self.scoreboard.stop()
+        if self.journal:
+          self.journal.close()
+        if self.metrics:
+          self.metrics.stop()
+        if self.lights:
+          self.lights.off()
+          self.lights.close() # Waits for the I2C write
         await server.close()
       finally:
         sys.exit(0)     
@@ -0,0 +1,97 @@
+# State of the current session, for clients that join late.
+#
+# A phone that joins mid-heat, or comes back after the app was in the background, only
+# gets the packets sent after its HELLO. UnicastServer passes every packet it sends to
+# Session.update(), which keeps per uid the timer value of the last crossing, the number of
+# crossings and the lap count of the last lap event, the latest device timer value, the
+# lights, the last start packet and the last device packet of each device. When a client
+# registers, the server sends it the snapshot as one JSON datagram, or a few for a large
+# field:
+#
+#   {"type": "snapshot", "last_seq": 1234, "time": 5678, "lights": 40, "start": {...},
+#    "devices": [{...}], "cars": [[uid, last crossing, crossings, laps], ...], "part": 1, "parts": 1}
+#
+# last_seq is the sequence number of the last packet in the snapshot; the client can drop
+# packets up to it that arrive afterwards. laps is null without --laps.
+
+import json
+
+
+class Session:
+  """ Incrementally updated snapshot of the session """
+
+  TYPE = 'snapshot'
+  KEY_TYPE = 'type'
+  KEY_TIME = 'time'
+  KEY_UID = 'uid'
+  KEY_DEVICE = 'device'
+  LAP = 'lap' # Types of the packets that change the snapshot, see Race, CreateService
+  START = 'start'
+  DEVICE = 'device'
+  CARS_PER_DATAGRAM = 32 # Fits in Fanout.MAX_DATAGRAM with 10-digit timer values
+
+  def __init__(self, finish = None):
+    """
+    :param finish: the name of the device at start/finish when there are several, None for one device
+    """
+    self.finish = finish
+    self.lights = None # Lights, for their latest value
+    self.devices = {} # Device name or None: the last device packet
+    self.reset()
+
+
+  def reset(self):
+    """ Starts a new race, the lights and the device state are kept """
+    self.cars = {} # uid: [timer value of the last crossing, crossings, laps]
+    self.time = None # Latest device timer value
+    self.start = None # The last start packet
+
+
+  def update(self, packet):
+    """ Adds a packet sent to the clients """
+    kind = packet.get(self.KEY_TYPE)
+    if kind is None: # Device frame
+      timer_value = packet[self.KEY_TIME]
+      self.time = timer_value
+      uid = packet[self.KEY_UID]
+      if uid and packet.get(self.KEY_DEVICE) == self.finish:
+        car = self.cars.get(uid)
+        if car is None:
+          self.cars[uid] = [timer_value, 1, None]
+        else:
+          car[0] = timer_value
+          car[1] += 1
+    elif kind == self.LAP:
+      car = self.cars.get(packet[self.KEY_UID])
+      if car is not None:
+        car[2] = packet[self.LAP]
+    elif kind == self.START:
+      self.start = packet
+    elif kind == self.DEVICE:
+      self.devices[packet.get(self.KEY_DEVICE)] = packet
+
+
+  def encode(self, last_seq, uids = None):
+    """
+    Returns the snapshot as a list of JSON datagrams.
+
+    :param last_seq: the sequence number of the last packet sent
+    :param uids: the uids the client subscribed to, None for all
+    """
+    cars = [[uid] + car for uid, car in self.cars.items() if uids is None or uid in uids]
+    parts = max(1, -(-len(cars) // self.CARS_PER_DATAGRAM))
+    datagrams = []
+    for part in range(parts):
+      first = part * self.CARS_PER_DATAGRAM
+      datagrams.append(json.dumps({
+        self.KEY_TYPE: self.TYPE,
+        'last_seq': last_seq,
+        self.KEY_TIME: self.time,
+        'lights': self.lights.value if self.lights else None,
+        'start': self.start,
+        'devices': list(self.devices.values()),
+        'cars': cars[first:first + self.CARS_PER_DATAGRAM],
+        'part': part + 1,
+        'parts': parts
+      }).encode())
+    return datagrams
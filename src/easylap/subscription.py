@@ -0,0 +1,109 @@
+# What a client wants to receive.
+#
+# A client can narrow down what it receives with HELLO options:
+#
+#   HELLO uids=3,17 types=car,lap timer_rate=0.2
+#
+# uids are transponder ids, types are packet types: 'timer' and 'car' for device frames,
+# the 'type' of other packets ('lap', 'start', 'device'...). timer_rate is the maximum
+# number of timer packets per second. Packets without a uid pass the uid filter. Clients
+# with equal subscriptions are grouped together by UnicastServer, so a packet is matched
+# once per group and not once per client.
+#
+# A filtered client sees gaps in the sequence numbers. Packets sent to a filtered group
+# also carry the sequence number of the previous packet sent to that group ('prev'), so
+# that the client asks for a resend only when something it wanted was lost. Timer packets
+# are not resent to a client with a timer_rate: the next one will do.
+
+import math
+
+
+class Subscription:
+  """ Packet filter of a group of clients """
+
+  __slots__ = ('uids', 'types', 'timer_rate')
+
+  KEY_UIDS = 'uids'
+  KEY_TYPES = 'types'
+  KEY_TIMER_RATE = 'timer_rate'
+  KEY_TYPE = 'type'
+  KEY_UID = 'uid'
+  TIMER = 'timer'
+  CAR = 'car'
+
+  def __init__(self, uids = None, types = None, timer_rate = None):
+    """
+    :param uids: iterable of transponder ids, None for all
+    :param types: iterable of packet types, None for all
+    :param timer_rate: maximum timer packets per second, None for all
+    """
+    self.uids = frozenset(uids) if uids is not None else None
+    self.types = frozenset(types) if types is not None else None
+    self.timer_rate = timer_rate
+
+
+  @classmethod
+  def parse(cls, options):
+    """
+    Returns the subscription in HELLO options, None if there is none.
+
+    :param options: dict of HELLO options
+    :raise ValueError: if an option cannot be parsed
+    """
+    uids = options.get(cls.KEY_UIDS)
+    types = options.get(cls.KEY_TYPES)
+    timer_rate = options.get(cls.KEY_TIMER_RATE)
+    if uids is None and types is None and timer_rate is None:
+      return None
+    if timer_rate is not None:
+      timer_rate = float(timer_rate)
+      if not math.isfinite(timer_rate) or timer_rate < 0:
+        raise ValueError('Bad timer_rate: {}'.format(timer_rate))
+    return cls(
+      [int(uid) for uid in uids.split(',') if uid] if uids is not None else None,
+      [t for t in types.split(',') if t] if types is not None else None,
+      timer_rate)
+
+
+  def options(self):
+    """ Returns the HELLO options, the opposite of parse() """
+    options = {}
+    if self.uids is not None:
+      options[self.KEY_UIDS] = ','.join(str(uid) for uid in sorted(self.uids))
+    if self.types is not None:
+      options[self.KEY_TYPES] = ','.join(sorted(self.types))
+    if self.timer_rate is not None:
+      options[self.KEY_TIMER_RATE] = '{:g}'.format(self.timer_rate)
+    return options
+
+
+  @classmethod
+  def kind(cls, packet):
+    """ Returns the type of a packet """
+    kind = packet.get(cls.KEY_TYPE)
+    if kind is None:
+      kind = cls.CAR if packet.get(cls.KEY_UID) else cls.TIMER
+    return kind
+
+
+  def matches(self, packet, kind = None):
+    """ True if the packet passes the uid and type filters, the timer rate is up to the caller """
+    if self.types is not None and (kind or self.kind(packet)) not in self.types:
+      return False
+    if self.uids is not None:
+      uid = packet.get(self.KEY_UID)
+      if uid and uid not in self.uids: # Timer packets have uid 0
+        return False
+    return True
+
+
+  def __eq__(self, other):
+    return isinstance(other, Subscription) and (self.uids, self.types, self.timer_rate) == (other.uids, other.types, other.timer_rate)
+
+
+  def __hash__(self):
+    return hash((self.uids, self.types, self.timer_rate))
+
+
+  def __repr__(self):
+    return 'Subscription({})'.format(' '.join('{}={}'.format(key, value) for key, value in self.options().items()))
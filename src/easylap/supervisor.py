@@ -0,0 +1,127 @@
+# Keeps the EasyLap device connected.
+#
+# On Linux the CP2110 shows up as /sys/class/hidraw/hidrawN. While the device is missing,
+# the supervisor scans that directory for an entry with the EasyLap vendor and product id
+# (a few small file reads) and opens the device as soon as it appears, so a bumped cable
+# costs tens of milliseconds instead of seconds. Where sysfs cannot tell (Mac, the fake
+# cp2110 library) it simply tries to open the device. Open attempts that fail back off
+# exponentially. The AioEasyLapDevice is reused: only its HID handle is opened again.
+#
+# State changes go to a callback, e.g. to tell the clients that the device is gone.
+
+import asyncio
+import os
+
+from . import backend
+from .aiodevice import AioEasyLapDevice
+from .base import Base, LogOptions
+from .device import EasyLapDeviceException
+
+
+class DeviceSupervisor(Base):
+  """ Opens the device, runs a reader, opens the device again when the reader fails """
+
+  CONNECTED = 'connected'
+  DISCONNECTED = 'disconnected'
+  SYSFS = '/sys/class/hidraw'
+  SCAN_INTERVAL = 0.05 # Seconds between sysfs scans while the device is missing
+  MIN_BACKOFF = 0.05 # Seconds after the first failed open
+  MAX_BACKOFF = 2.0
+  STABLE = 1.0 # Seconds, a connection that fails sooner counts as a failed attempt
+
+  def __init__(self, device, on_state = None, log_options = LogOptions()):
+    """
+    :param device: an AioEasyLapDevice, opened or not
+    :param on_state: callback that receives CONNECTED or DISCONNECTED
+    :param log_options: the log options
+    """
+    super().__init__('DeviceSupervisor', log_options)
+    self.device = device
+    self.on_state = on_state
+    self.state = self.DISCONNECTED
+    self.connects = 0 # Times the device was opened
+    self.failures = 0 # Open attempts that failed
+    self.backoff = self.MIN_BACKOFF # Before reopening after a short connection
+    self.hid_id = ':{:08X}:{:08X}'.format(AioEasyLapDevice.EASYLAP_VID, AioEasyLapDevice.EASYLAP_PID)
+    self.watch = not backend.is_fake(backend.cp2110()) and os.path.isdir(self.SYSFS)
+
+
+  def present(self):
+    """ True if the device is plugged in, False if not, None if this cannot be known """
+    if not self.watch:
+      return None
+    try:
+      names = os.listdir(self.SYSFS)
+    except OSError:
+      return None
+    for name in names:
+      try:
+        with open(os.path.join(self.SYSFS, name, 'device', 'uevent')) as f:
+          if self.hid_id in f.read(): # HID_ID=0003:000010C4:000086B9
+            return True
+      except OSError:
+        pass
+    return False
+
+
+  async def connect(self):
+    """ Returns when the device is open """
+    backoff = self.MIN_BACKOFF
+    missing = False
+    while True:
+      if self.present() is False:
+        if not missing:
+          self.info('Waiting for the device')
+          missing = True
+        await asyncio.sleep(self.SCAN_INTERVAL)
+        continue
+      try:
+        self.device.open()
+        return
+      except EasyLapDeviceException as e:
+        self.failures += 1
+        self.debug('Cannot open device: %s, retrying in %.2f s', e.wrapped, backoff)
+      await asyncio.sleep(backoff)
+      backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+
+  def set_state(self, state):
+    if state == self.state:
+      return
+    self.state = state
+    self.info('Device %s', state)
+    if self.on_state:
+      try:
+        self.on_state(state)
+      except Exception as e:
+        self.error('Cannot handle device state: %s', e)
+
+
+  async def run(self, reader):
+    """
+    Runs forever.
+
+    :param reader: async function that reads the open device until it fails
+    """
+    loop = asyncio.get_running_loop()
+    try:
+      while True:
+        await self.connect()
+        self.connects += 1
+        self.set_state(self.CONNECTED)
+        connected_at = loop.time()
+        try:
+          await reader(self.device)
+        except EasyLapDeviceException as e:
+          self.debug('Device error: %s', e.wrapped)
+        finally:
+          self.device.close()
+        self.set_state(self.DISCONNECTED)
+        if loop.time() - connected_at < self.STABLE: # Opens but does not read, do not spin
+          self.failures += 1
+          await asyncio.sleep(self.backoff)
+          self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+        else:
+          self.backoff = self.MIN_BACKOFF
+    finally:
+      self.device.close()
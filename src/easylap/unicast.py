@@ -25,6 +25,20 @@ class Unicast(Base):
     return ip
   
   
+  def multicast_socket(self, group, port, interface):
+    """ Returns a non-blocking socket that receives the datagrams sent to a multicast group """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Other clients on this host
+      sock.bind(('', port))
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(interface))
+      sock.setblocking(False)
+    except OSError:
+      sock.close()
+      raise
+    return sock
+
+
   def get_my_ip6(self):
     """ Returns the IPv6 address. Not reliable: returns a temporary address. """
     s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
@@ -1,11 +1,30 @@
 # asyncio version of zeroconf from https://github.com/frawau/aiozeroconf
 # From https://wiki.python.org/moin/UdpCommunication
+#
+# If the server advertises a multicast group in its TXT record, the client joins it. While
+# packets arrive from the group, HELLO says 'multicast=1' and the server stops sending them
+# by unicast; duplicates during the switch are dropped by sequence number. When nothing has
+# come from the group for MULTICAST_TIMEOUT seconds the client says so at once and gets
+# unicast again.
 
 import asyncio
 import ipaddress
-from aiozeroconf import ServiceBrowser, Zeroconf
+import json
+import time
 from .base import LogOptions
+from .subscription import Subscription
 from .unicast import Unicast
+from .wire import Encoding
+
+
+class MulticastListener(asyncio.DatagramProtocol):
+  """ Receives from the multicast group for a UnicastClient """
+
+  def __init__(self, client):
+    self.client = client
+
+  def datagram_received(self, data, addr):
+    self.client.multicast_received(data, addr)
 
 
 class UnicastClient(Unicast):
@@ -16,9 +35,20 @@ class UnicastClient(Unicast):
   port = None
   transport = None
   callback = None
+  encoding = None
+  subscription = None # None for everything
+  last_seq = None # The highest sequence number received
+  missing = None # Sequence numbers asked for with RESEND
+  MAX_MISSING = 1024 # Do not ask for more than this, the server does not keep more
+  RESEND_MAX = 64 # Packets per RESEND, the server sends no more for one
   zeroconf = None
   browser = None
   ping_task = None
+  multicast = True # Join the group the server advertises, False never, or (group, port)
+  multicast_transport = None
+  multicast_seen = None # time.monotonic() of the last datagram from the group
+  MULTICAST_TIMEOUT = 5 # Seconds without a datagram from the group before asking for unicast again
+  PING_INTERVAL = 10 # Seconds between HELLO messages
   
   remote_addr = None
   remove_port = None
@@ -26,18 +56,25 @@ class UnicastClient(Unicast):
   
   """ UDP client
   """
-  def __init__(self, service='_easylap._udp.local.', port=5006, callback=None, log_options = LogOptions()):
+  def __init__(self, service='_easylap._udp.local.', port=5006, callback=None, log_options = LogOptions(), encoding = Encoding.JSON, subscription = None, multicast = True):
     """
     :param service: the service name
     :param port: the local port
-    :param callback: called when data is received 
+    :param callback: called when data is received: with the message for JSON, with a dict for each binary packet
     :param log_options: log options
+    :param encoding: the wire encoding requested from the server, Encoding.JSON or Encoding.BINARY
+    :param subscription: a Subscription, what to receive, None for everything
+    :param multicast: True to join the multicast group the server advertises, False for unicast only, or (group, port) to join
     """
     super().__init__('UnicastClient', log_options)
     self.ip_addr = self.get_my_ip() # Call only once!!!
     self.service = service
     self.port = port
     self.callback = callback
+    self.encoding = encoding
+    self.subscription = subscription
+    self.multicast = multicast
+    self.missing = set()
     self.logger.info('Client starting...')
 
 
@@ -65,10 +102,89 @@ class UnicastClient(Unicast):
   def datagram_received(self, data, addr):
     """ Callback for create_datagram_endpoint """
     self.logger.debug('datagram_received')
-    message = data.decode()
-    if self.callback:
-      self.callback(message)
-    self.logger.debug('Received %r from %s' % (message, addr))
+    if Encoding.is_binary(data):
+      try:
+        packets = Encoding.decode(data)
+      except Exception as e:
+        self.logger.warning('Cannot decode: %r - %s', data, e)
+        return
+      for packet in packets:
+        if self.accept(packet.get(Encoding.KEY_SEQ), addr, packet.get(Encoding.KEY_PREV)) and self.callback:
+          self.callback(packet)
+      self.logger.debug('Received %r from %s', packets, addr)
+      return
+    for message in data.decode().split('\n'): # More than one if the server coalesces packets
+      try:
+        packet = json.loads(message)
+        seq, prev = packet.get(Encoding.KEY_SEQ), packet.get(Encoding.KEY_PREV)
+      except Exception:
+        seq = prev = None
+      if self.accept(seq, addr, prev) and self.callback:
+        self.callback(message)
+      self.logger.debug('Received %r from %s', message, addr)
+
+
+  async def join_multicast(self, group, port):
+    """ Receives the packets the server sends to a multicast group """
+    if self.multicast_transport:
+      return
+    loop = asyncio.get_running_loop()
+    try:
+      sock = self.multicast_socket(group, port, self.ip_addr)
+      self.multicast_transport, protocol = await loop.create_datagram_endpoint(lambda: MulticastListener(self), sock=sock)
+      self.logger.info('Joined multicast group: %s:%s', group, port)
+    except OSError as e:
+      self.logger.warning('Cannot join multicast group %s:%s - %s', group, port, e)
+
+
+  def multicast_received(self, data, addr):
+    """ Called by the MulticastListener """
+    self.multicast_seen = time.monotonic()
+    self.datagram_received(data, addr)
+
+
+  def receives_multicast(self):
+    """ True if packets came from the multicast group recently """
+    seen = self.multicast_seen
+    return seen is not None and time.monotonic() - seen < self.MULTICAST_TIMEOUT
+
+
+  def accept(self, seq, addr, prev = None):
+    """
+    Detects gaps in the sequence numbers and asks the server to resend the missing packets.
+
+    :param seq: the sequence number of a received packet, None if the packet has none
+    :param addr: the server address
+    :param prev: the sequence number of the previous packet sent to this client, None if the client gets all packets
+    :return: False if the packet is a duplicate
+    """
+    if seq is None:
+      return True
+    last = self.last_seq
+    if last is None or seq == last + 1 or (prev is not None and prev <= last < seq): # Filtered out, not lost
+      self.last_seq = seq
+      return True
+    if seq > last + 1: # Gap
+      end = seq - 1 if prev is None else prev
+      first = max(last + 1, end + 1 - self.MAX_MISSING)
+      self.logger.info('Missing packets %s-%s, asking for resend', first, end)
+      self.missing.update(range(first, end + 1))
+      if len(self.missing) > self.MAX_MISSING: # Give up on the oldest
+        self.missing = set(sorted(self.missing)[-self.MAX_MISSING:])
+      if self.transport:
+        for start in range(first, end + 1, self.RESEND_MAX):
+          self.transport.sendto('RESEND {} {}'.format(start, min(end, start + self.RESEND_MAX - 1)).encode(), addr)
+      self.last_seq = seq
+      return True
+    if seq in self.missing: # Resent
+      self.missing.discard(seq)
+      return True
+    if (seq == 1 and last > 1) or last - seq > self.MAX_MISSING: # The server was restarted
+      self.logger.info('Sequence restarted at %s', seq)
+      self.missing.clear()
+      self.last_seq = seq
+      return True
+    return False # Duplicate
 
     
   def connection_lost(self, exc):
@@ -88,6 +204,7 @@ class UnicastClient(Unicast):
   def browse_for_service(self):
     self.logger.debug('browse_for_service')
     self.logger.info('Browsing for service...')
+    from aiozeroconf import ServiceBrowser, Zeroconf # Only when browsing, it is slow to import
     loop = asyncio.get_event_loop()
     self.zeroconf = Zeroconf(loop)
     self.browser = ServiceBrowser(self.zeroconf, self.service, self)
@@ -109,20 +226,59 @@ class UnicastClient(Unicast):
     
     self.remote_addr = addr
     self.remote_port = port
+    advertised = (info.properties or {}).get(b'multicast')
+    if isinstance(self.multicast, tuple):
+      await self.join_multicast(*self.multicast)
+    elif advertised and self.multicast:
+      group, _, group_port = advertised.decode().partition(':')
+      await self.join_multicast(group, int(group_port))
     # FIXME: bad design, this should not be here:
     if self.transport:
       self.ping_task = asyncio.create_task(self.ping(self.transport, addr, port))
 
 
+  def hello(self):
+    """ Returns the HELLO message, with the options this client requests """
+    message = 'HELLO'
+    if self.encoding != Encoding.JSON:
+      message += ' encoding={}'.format(self.encoding)
+    if self.subscription:
+      for key, value in self.subscription.options().items():
+        message += ' {}={}'.format(key, value)
+    if self.receives_multicast():
+      message += ' multicast=1'
+    return message.encode()
+
+
+  def subscribe(self, uids = None, types = None, timer_rate = None):
+    """
+    Changes what this client receives, see Subscription. Without arguments, everything.
+
+    :param uids: iterable of transponder ids, None for all
+    :param types: iterable of packet types, e.g. ('car', 'lap'), None for all
+    :param timer_rate: maximum timer packets per second, None for all
+    """
+    subscription = Subscription(uids, types, timer_rate)
+    self.subscription = subscription if subscription.options() else None
+    if self.transport and self.remote_addr and self.remote_port:
+      self.transport.sendto(self.hello(), (self.remote_addr, self.remote_port))
+
+
   async def ping(self, transport, addr, port):
     self.logger.debug('ping')
+    pinged = None
+    multicast = None
     while True:
-      self.logger.debug('Pinging {} on port {}'.format(addr, port))
-      transport.sendto(b'HELLO', (addr, port))
-      await asyncio.sleep(10) # 10 seconds between pings
+      now = time.monotonic()
+      if pinged is None or now - pinged >= self.PING_INTERVAL or self.receives_multicast() != multicast: # Or at once when multicast starts or stops
+        self.logger.debug('Pinging %s on port %s', addr, port)
+        multicast = self.receives_multicast()
+        transport.sendto(self.hello(), (addr, port))
+        pinged = now
+      await asyncio.sleep(1 if self.multicast_transport else self.PING_INTERVAL)
       
   async def send(self, message):
-    self.logger.debug('send: {}'.format(message))
+    self.logger.debug('send: %s', message)
     if self.remote_addr and self.remote_port:
       self.transport.sendto(message.encode(), (self.remote_addr, self.remote_port))
     else:
@@ -139,6 +295,9 @@ class UnicastClient(Unicast):
     self.logger.debug('cleanup')
     if self.ping_task:
       self.ping_task.cancel()
+    if self.multicast_transport:
+      self.multicast_transport.close()
+      self.multicast_transport = None
     if self.transport:
       self.transport.close()
 
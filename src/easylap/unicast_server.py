@@ -21,14 +21,37 @@
 #
 # Better idea: install Python 3.9 on Raspberry Pi?
 # On Raspbery Pi the log info goes to /var/log/user.log 
+#
+# Dead clients: on Linux the socket has IP_RECVERR set, so ICMP errors (port or host
+# unreachable, e.g. a phone that left the Wi-Fi) are queued with the destination address of
+# the datagram that failed. error_received() reads that queue and reports each address to
+# the client registry, which removes a client after a few failures instead of sending to it
+# until it expires. A sendto() that fails is reported the same way. With IP_RECVERR the
+# ICMP error is also left pending on the socket and the next sendto() fails with it, even
+# to another client: when the queue had addresses, that datagram is sent again (see Fanout).
+#
+# Multicast (optional): where multicast works (Android, Linux; not iOS 14+ without an
+# entitlement), every packet is also sent once to a multicast group, advertised in the
+# mDNS TXT record as 'multicast=GROUP:PORT'. A client that receives from the group says so
+# with 'HELLO multicast=1' and is taken off the unicast fan-out; one sendto() then serves
+# all of them. Only JSON clients without a subscription are taken off, the others and
+# clients that stop reporting multicast get unicast as before. RESEND stays unicast.
 
 import asyncio
+import itertools
+import json
 import socket
+import sys
 import time
-from aiozeroconf import ServiceInfo, Zeroconf
+from collections import deque
 
 from .base import LogOptions
+from .clients import ClientRegistry
+from .fanout import Fanout
+from .frame import Frame
+from .subscription import Subscription
 from .unicast import Unicast
+from .wire import Encoding
 
 
 class UnicastServer(Unicast):
@@ -36,7 +59,14 @@ class UnicastServer(Unicast):
   
   HELLO = 'HELLO'
   BYE = 'BYE'
-  TIMEOUT = 15 # Remove client if not seen for this many seconds
+  RESEND = 'RESEND'
+  STATS = 'STATS'
+  HISTORY = 1024 # Packets kept for RESEND
+  RESEND_MAX = 64 # Packets sent for one RESEND, the client asks again for the rest
+  IP_RECVERR = getattr(socket, 'IP_RECVERR', 11) # Linux
+  KEY_MULTICAST = 'multicast'
+  MULTICAST_PORT = 5007
+  ERRORS_MAX = 64 # Errors read from the error queue at once
 
   name = None
   version = None
@@ -44,11 +74,20 @@ class UnicastServer(Unicast):
   service = None
   port = None
   transport = None
-  clients = {} # Last seen in the form (ip_addr, port):time
+  clients = None # ClientRegistry
+  seq = 0 # Sequence number of the last packet
+  history = None # The last packets sent, oldest first
+  group_seq = None # Sequence number of the last packet sent to each filtered group
+  timer_sent = None # time.monotonic() of the last timer packet sent to each rate limited group
   zeroconf = None
+  error_socket = None # The endpoint socket, to read its error queue
+  multicast = None # (group, port), if packets are also multicast
+  fanout = None
+  metrics = None # Answers STATS, if set
+  session = None # Session, sent to new clients, if set
   
   
-  def __init__(self, name = 'EasyLap Service', service='_easylap._udp.local.', version = '0.0.1', port=5005, log_options = LogOptions(), command_handler = None):
+  def __init__(self, name = 'EasyLap Service', service='_easylap._udp.local.', version = '0.0.1', port=5005, log_options = LogOptions(), command_handler = None, coalesce = 0, history = HISTORY, max_clients = ClientRegistry.MAX_CLIENTS, client_timeout = ClientRegistry.TIMEOUT, max_failures = ClientRegistry.MAX_FAILURES, multicast = None, max_per_host = ClientRegistry.MAX_PER_HOST):
     """
     
     :param service: the service name
@@ -56,6 +95,13 @@ class UnicastServer(Unicast):
     :param port: the local port
     :param log_options: the log options
     :param command_handler: callback that receives messages from clients
+    :param coalesce: seconds to wait for more packets before sending, 0 sends immediately
+    :param history: the number of packets kept for clients that ask for a resend
+    :param max_clients: the maximum number of registered clients, the least recently seen is evicted
+    :param client_timeout: seconds without a HELLO before a client is removed
+    :param max_failures: undelivered datagrams since the last HELLO before a client is removed, 0 never removes
+    :param multicast: (group, port) to send every packet to once, for the clients that receive it, None for unicast only
+    :param max_per_host: the maximum number of registered clients from one IP address
     
     """
     super().__init__('UnicastServer', log_options)
@@ -65,11 +111,19 @@ class UnicastServer(Unicast):
     self.version = version
     self.port = port
     self.command_handler = command_handler
+    self.multicast = multicast
+    self.clients = ClientRegistry(timeout = client_timeout, max_clients = max_clients, max_per_host = max_per_host, on_remove = self.removed, max_failures = max_failures)
+    self.history = deque(maxlen=history)
+    self.group_seq = {}
+    self.timer_sent = {}
+    self.fanout = Fanout(coalesce)
+    self.fanout.on_error = self.clients.send_failed
     self.logger.info('Server starting...')
     
     
   async def register_service(self):
     self.logger.debug('register_service')
+    from aiozeroconf import ServiceInfo, Zeroconf # Only when advertising, it is slow to import
     name = self.name
     service = self.service
     ip_addr = self.ip_addr
@@ -79,6 +133,8 @@ class UnicastServer(Unicast):
     fqdn = socket.gethostname()
     hostname = fqdn.split('.')[0]  
     desc = {'service': name, 'version': version}
+    if self.multicast:
+      desc[self.KEY_MULTICAST] = '{}:{}'.format(*self.multicast)
     info = ServiceInfo(
             service,
             "{}.{}".format(name,  service),
@@ -112,50 +168,250 @@ class UnicastServer(Unicast):
     self.logger.debug('connection_made')
     """ Callback for create_datagram_endpoint """
     self.transport = transport
+    self.fanout.transport = transport
+    self.error_socket = self.receive_errors(transport)
+    if self.multicast:
+      sock = transport.get_extra_info('socket')
+      try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.ip_addr)) # Not the default route
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1) # This network only
+      except OSError as e:
+        self.logger.warning('Cannot multicast: %s', e)
+        self.multicast = None
+    self.update_fanout()
+
+
+  def receive_errors(self, transport):
+    """ Turns on IP_RECVERR, returns a socket to read the error queue or None where not supported """
+    if not sys.platform.startswith('linux'):
+      return None
+    sock = transport.get_extra_info('socket')
+    try:
+      errors = socket.fromfd(sock.fileno(), sock.family, sock.type) # The same socket, this one has recvmsg()
+      errors.setsockopt(socket.IPPROTO_IP, self.IP_RECVERR, 1)
+      return errors
+    except (AttributeError, OSError) as e:
+      self.logger.warning('Cannot receive ICMP errors: %s', e)
+      return None
+
+
+  def error_received(self, exc):
+    """ Callback for create_datagram_endpoint: a sendto() failed or an ICMP error arrived """
+    addresses = self.read_errors()
+    for addr in addresses:
+      self.fanout.failed(addr)
+    if self.fanout.sending: # Called from sendto(), which failed with the error of these addresses or its own
+      self.fanout.unsent(stale = bool(addresses))
+    self.logger.debug('Send error: %s %s', exc, addresses or self.fanout.sending or '')
+
+
+  def read_errors(self):
+    """ Returns the destination addresses of the datagrams in the error queue, and empties it """
+    addresses = []
+    sock = self.error_socket
+    if sock:
+      for i in range(self.ERRORS_MAX):
+        try:
+          data, ancdata, flags, addr = sock.recvmsg(1, 256, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+        except OSError: # Empty
+          break
+        if addr:
+          addresses.append(addr)
+    return addresses
 
     
   def datagram_received(self, data, addr):
     self.logger.debug('datagram_received')
     """ Callback for create_datagram_endpoint """
     message = data.decode()
-    self.logger.debug('Received %r from %s' % (message, addr))
+    self.logger.debug('Received %r from %s', message, addr)
     # Addr is a tuple (INET, PORT)
-    if message == self.HELLO:
-      if not addr in self.clients:
-        self.logger.info('Adding client: {}'.format(addr)) 
-      self.clients[addr] = int(time.time()) # Register client, update last seen (don't do it only once!)
+    command, _, args = message.partition(' ')
+    if command == self.HELLO:
+      self.hello(addr, self.parse_options(args))
     elif message == self.BYE:
-      self.logger.info('Removing client: {}'.format(addr)) 
-      self.clients.pop(addr) # Remove record
+      if self.clients.pop(addr): # Unknown clients are ignored
+        self.logger.info('Removing client: %s', addr)
+        self.update_fanout()
+    elif command == self.RESEND:
+      self.resend(addr, args)
+    elif command == self.STATS:
+      if self.metrics and self.transport and addr in self.clients: # Registered only, like RESEND
+        self.transport.sendto(json.dumps(self.metrics.snapshot(self.metrics.STATS_CLIENTS)).encode(), addr)
     elif self.command_handler: # Handle custom commands 
       try:
         self.command_handler(message)
       except Exception as e:
-        self.logger.warning('Cannot handle command: {} - {}'.format(message, e))
-      
-    self.purge_clients()
+        self.logger.warning('Cannot handle command: %s - %s', message, e)
+
+
+  def parse_options(self, args):
+    """ Parses 'key=value key=value' into a dict """
+    options = {}
+    for option in args.split():
+      key, _, value = option.partition('=')
+      options[key] = value
+    return options
 
 
-  def purge_clients(self):
-    self.logger.debug('purge_clients')
-    now = int(time.time())
-    for addr in [c for c in self.clients.keys()]: # Make an immutable copy of the keys list. Remember, addr = (IP, PORT)
-      then = self.clients[addr]
-      if now - then > self.TIMEOUT:
-        self.logger.info('Removing client: {}'.format(addr)) 
-        self.clients.pop(addr)
+  def hello(self, addr, options):
+    """ Registers a client or updates its last seen time and options """
+    encoding = options.get('encoding', Encoding.JSON)
+    if encoding not in Encoding.ALL:
+      self.logger.warning('Unknown encoding: %s, using %s', encoding, Encoding.JSON)
+      encoding = Encoding.JSON
+    try:
+      subscription = Subscription.parse(options)
+    except ValueError as e:
+      self.logger.warning('Bad subscription from %s: %s', addr, e)
+      subscription = None
+    known = self.clients.get(addr)
+    if not known:
+      self.logger.info('Adding client: %s (%s) %s', addr, encoding, subscription or '')
+    multicast = bool(known) and self.receives_multicast(known)
+    client, changed = self.clients.hello(addr, encoding, options, subscription) # Update last seen (don't do it only once!)
+    if changed:
+      if self.multicast and self.receives_multicast(client) != multicast:
+        self.logger.info('Client %s: %s', addr, 'unicast' if multicast else 'multicast')
+      self.update_fanout()
+    if not known and self.session and self.transport: # Before the next packet
+      for data in self.session.encode(self.seq, subscription.uids if subscription else None):
+        self.transport.sendto(data, addr)
+
+
+  def resend(self, addr, args):
+    """
+    Sends packets from the history again to one client.
+
+    :param addr: the client address
+    :param args: '<from> <to>', inclusive sequence numbers
+    """
+    client = self.clients.get(addr)
+    if not client or not self.history or not self.transport:
+      return
+    try:
+      first, last = (int(arg) for arg in args.split())
+    except ValueError:
+      self.logger.warning('Bad RESEND from %s: %s', addr, args)
+      return
+    oldest = self.seq - len(self.history) + 1
+    first = max(first, oldest)
+    last = min(last, self.seq, first + self.RESEND_MAX - 1)
+    if first > last:
+      return
+    encoding = client.encoding
+    subscription = client.subscription
+    limited = subscription is not None and subscription.timer_rate is not None
+    for packet in itertools.islice(self.history, first - oldest, last - oldest + 1):
+      if subscription:
+        kind = Subscription.kind(packet)
+        if not subscription.matches(packet, kind) or (limited and kind == Subscription.TIMER):
+          continue
+      self.transport.sendto(Encoding.encode(packet, encoding, packet[Encoding.KEY_SEQ]), addr)
+      if type(packet) is Frame:
+        packet.json = packet.binary = None
+
+
+  def update_fanout(self):
+    """ Groups the clients by encoding and subscription. Call when the set of clients changes. """
+    groups = {}
+    for client in self.clients.values():
+      if self.multicast and self.receives_multicast(client):
+        continue
+      groups.setdefault((client.encoding, client.subscription), []).append(client.addr)
+    if self.multicast and self.clients: # Also for clients that have not received from the group yet
+      groups.setdefault((Encoding.JSON, None), []).append(self.multicast)
+    self.fanout.update(groups)
+    self.fanout.separators = {key: Encoding.SEPARATORS[key[0]] for key in groups}
+    self.group_seq = {key: seq for key, seq in self.group_seq.items() if key in groups}
+    self.timer_sent = {key: sent for key, sent in self.timer_sent.items() if key in groups}
+
+
+  def receives_multicast(self, client):
+    """ True if the client gets the packets from the multicast group instead of unicast """
+    return client.options.get(self.KEY_MULTICAST) == '1' and client.encoding == Encoding.JSON and client.subscription is None
+
+
+  def removed(self, clients):
+    """ Called by the registry when clients expire or are evicted """
+    for client in clients:
+      self.logger.info('Removing client: %s', client.addr)
+    self.update_fanout()
 
   
   async def send(self, data):
+    """ Sends raw bytes to all clients """
     self.logger.debug('send')
-    self.logger.debug('send clients: {}'.format([c for c in self.clients.keys()]))
-    if self.transport:
-      for addr_port in self.clients.keys():
-        self.transport.sendto(data, addr_port)
-    self.purge_clients()
+    self.fanout.send(data)
+
+
+  async def send_packet(self, packet):
+    """
+    Sends a packet to the clients that subscribed to it. Encoded once for each encoding
+    used by clients without a subscription, once for each matching filtered group.
+
+    :param packet: a dict, e.g. {'time': timer_value, 'uid': uid}. Gets a 'seq' key.
+    """
+    self.seq += 1
+    seq = self.seq
+    packet[Encoding.KEY_SEQ] = seq
+    self.history.append(packet)
+    if self.session:
+      self.session.update(packet)
+    kind = Subscription.kind(packet)
+    frame = Encoding.is_frame(packet)
+    encoded = {}
+    now = None
+    for key in self.fanout.groups:
+      encoding, subscription = key
+      if subscription is None:
+        data = encoded.get(encoding)
+        if data is None:
+          data = encoded[encoding] = Encoding.encode(packet, encoding, seq)
+      else:
+        if not subscription.matches(packet, kind):
+          continue
+        if kind == Subscription.TIMER and subscription.timer_rate is not None:
+          now = now or time.monotonic()
+          sent = self.timer_sent.get(key)
+          if subscription.timer_rate <= 0 or (sent is not None and (now - sent) * subscription.timer_rate < 1):
+            continue
+          self.timer_sent[key] = now
+        data = Encoding.encode(packet, encoding, seq, self.group_seq.get(key, 0))
+        self.group_seq[key] = seq
+      if encoding == Encoding.BINARY and not frame: # JSON, do not coalesce with binary records
+        self.fanout.send_now(data, key)
+      else:
+        self.fanout.send(data, key)
+    if type(packet) is Frame: # Sent, the history keeps the frame without its datagrams
+      packet.json = packet.binary = None
+
+
+  def publish(self, packet):
+    """
+    Sends a packet outside of the sequence (no 'seq', not kept for RESEND) to the clients
+    that subscribed to its type by name, e.g. 'HELLO types=scoreboard'. Always JSON.
+    """
+    kind = packet.get(Subscription.KEY_TYPE)
+    data = None
+    for key in self.fanout.groups:
+      encoding, subscription = key
+      if subscription is None or subscription.types is None or kind not in subscription.types:
+        continue
+      if data is None:
+        data = json.dumps(packet).encode()
+      if encoding == Encoding.BINARY:
+        self.fanout.send_now(data, key)
+      else:
+        self.fanout.send(data, key)
 
     
   async def close(self, *args):
     """ Closes the server as the result of a Unix signal. Do not use logging here. Logging in signal handlers can cause problems. """
+    self.clients.close()
+    self.fanout.close()
+    if self.error_socket:
+      self.error_socket.close()
+      self.error_socket = None
     if self.zeroconf:
       await self.zeroconf.close()
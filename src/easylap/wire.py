@@ -0,0 +1,142 @@
+# Wire formats for packets sent to clients.
+#
+# JSON is the default and is what the iOS app understands. A client can ask for the
+# compact binary format by sending 'HELLO encoding=binary'. A binary packet is a fixed-size
+# little-endian record:
+#
+#   magic (1 byte, 0xE1) | type (1 byte, 0x0B timer / 0x0D car) | uid (2 bytes) | timer (4 bytes) | seq (4 bytes)
+#
+# Clients with a subscription filter (see the subscription module) also get the sequence
+# number of the previous packet sent to them: 'prev' in JSON, and in binary a record with
+# magic 0xE2 and 4 more bytes for prev after seq.
+#
+# Coalesced binary packets are simply concatenated. Messages that are not device frames
+# are always sent as JSON; a JSON datagram never starts with the magic byte.
+#
+# Every packet sent with UnicastServer.send_packet() carries a sequence number ('seq'
+# in JSON) so that clients can detect gaps and ask for a resend.
+#
+# Device frames (see the frame module) are encoded without a dict or json.dumps, into the
+# same bytes, and keep their encoding for the other groups of the same send. A RESEND
+# encodes them again.
+
+import json
+import struct
+
+from .frame import Frame
+
+
+class Encoding:
+  """ Encodes and decodes packets """
+
+  JSON = 'json'
+  BINARY = 'binary'
+  ALL = (JSON, BINARY)
+
+  KEY_TIME = 'time'
+  KEY_UID = 'uid'
+  KEY_SEQ = 'seq'
+  KEY_PREV = 'prev'
+  FRAME_KEYS = frozenset((KEY_TIME, KEY_UID, KEY_SEQ))
+
+  MAGIC = 0xE1
+  MAGIC_PREV = 0xE2
+  TIMER = 0x0B
+  CAR = 0x0D
+  BINARY_STRUCT = struct.Struct('<BBHII')
+  BINARY_PREV_STRUCT = struct.Struct('<BBHIII')
+  JSON_FRAME = b'{"time": %d, "uid": %d, "seq": %d}' # As json.dumps() writes a frame
+  JSON_FRAME_PREV = b'{"time": %d, "uid": %d, "seq": %d, "prev": %d}'
+
+  SEPARATORS = {JSON: b'\n', BINARY: b''} # Between coalesced packets
+
+
+  @classmethod
+  def encode(cls, packet, encoding = JSON, seq = 0, prev = None):
+    """
+    Encodes a packet.
+
+    :param packet: a dict, e.g. {'time': timer_value, 'uid': uid}, or a Frame
+    :param encoding: JSON or BINARY
+    :param seq: the sequence number, used by the binary format. JSON packets carry their own 'seq'.
+    :param prev: the sequence number of the previous packet sent to the same clients, None if they get all packets
+    :return: bytes
+    """
+    if type(packet) is Frame and packet.extra is None and packet.seq is not None:
+      if prev is not None or seq != packet.seq:
+        return cls.encode_frame(packet, encoding, seq, prev)
+      if encoding == cls.BINARY:
+        data = packet.binary
+        if data is None:
+          data = packet.binary = cls.encode_frame(packet, encoding, seq)
+        return data
+      data = packet.json
+      if data is None:
+        data = packet.json = cls.encode_frame(packet, encoding, seq)
+      return data
+    if encoding == cls.BINARY and cls.is_frame(packet):
+      uid = packet[cls.KEY_UID]
+      frame_type = cls.CAR if uid else cls.TIMER
+      timer_value = packet[cls.KEY_TIME] & 0xFFFFFFFF
+      if prev is None:
+        return cls.BINARY_STRUCT.pack(cls.MAGIC, frame_type, uid, timer_value, seq & 0xFFFFFFFF)
+      return cls.BINARY_PREV_STRUCT.pack(cls.MAGIC_PREV, frame_type, uid, timer_value, seq & 0xFFFFFFFF, prev & 0xFFFFFFFF)
+    if type(packet) is Frame:
+      packet = packet.to_dict()
+    elif prev is not None:
+      packet = dict(packet)
+    if prev is not None:
+      packet[cls.KEY_PREV] = prev
+    return json.dumps(packet).encode()
+
+
+  @classmethod
+  def encode_frame(cls, frame, encoding, seq, prev = None):
+    """ Encodes a Frame without other keys, see encode() """
+    uid = frame.uid
+    timer_value = frame.time & 0xFFFFFFFF
+    if encoding == cls.BINARY:
+      frame_type = cls.CAR if uid else cls.TIMER
+      if prev is None:
+        return cls.BINARY_STRUCT.pack(cls.MAGIC, frame_type, uid, timer_value, seq & 0xFFFFFFFF)
+      return cls.BINARY_PREV_STRUCT.pack(cls.MAGIC_PREV, frame_type, uid, timer_value, seq & 0xFFFFFFFF, prev & 0xFFFFFFFF)
+    if prev is None:
+      return cls.JSON_FRAME % (frame.time, uid, frame.seq)
+    return cls.JSON_FRAME_PREV % (frame.time, uid, frame.seq, prev)
+
+
+  @classmethod
+  def is_frame(cls, packet):
+    """ True if the packet is a device frame that fits the binary format """
+    if type(packet) is Frame:
+      return packet.extra is None
+    return cls.KEY_TIME in packet and cls.KEY_UID in packet and packet.keys() <= cls.FRAME_KEYS
+
+
+  @classmethod
+  def is_binary(cls, data):
+    return len(data) > 0 and (data[0] == cls.MAGIC or data[0] == cls.MAGIC_PREV)
+
+
+  @classmethod
+  def decode(cls, data):
+    """
+    Decodes a datagram.
+
+    :param data: bytes received from the server
+    :return: a list of dicts. Binary packets include the 'seq' key, and 'prev' if present.
+    """
+    if not cls.is_binary(data):
+      return [json.loads(line) for line in data.split(cls.SEPARATORS[cls.JSON]) if line]
+    packets = []
+    if data[0] == cls.MAGIC_PREV: # All packets of a datagram go to the same group
+      for magic, packet_type, uid, timer_value, seq, prev in cls.BINARY_PREV_STRUCT.iter_unpack(data):
+        if magic != cls.MAGIC_PREV:
+          raise ValueError('Bad magic: {}'.format(magic))
+        packets.append({cls.KEY_TIME: timer_value, cls.KEY_UID: uid, cls.KEY_SEQ: seq, cls.KEY_PREV: prev})
+      return packets
+    for magic, packet_type, uid, timer_value, seq in cls.BINARY_STRUCT.iter_unpack(data):
+      if magic != cls.MAGIC:
+        raise ValueError('Bad magic: {}'.format(magic))
+      packets.append({cls.KEY_TIME: timer_value, cls.KEY_UID: uid, cls.KEY_SEQ: seq})
+    return packets
@@ -0,0 +1,104 @@
+# Memory and time per 10k frames: the dict packets easylapd used before against Frame
+# objects. Each run decodes a synthetic stream and, as UnicastServer.send_packet() does,
+# gives every packet a sequence number, encodes it for two JSON and two binary groups and
+# keeps the last HISTORY packets for RESEND, without their encodings. Every mode runs in its own interpreter so that
+# the RSS figures do not mix.
+#
+#   python3 bench_frames.py --frames 10000
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from easylap.decoder import FrameDecoder
+from easylap.fake.stream import SyntheticStream
+from easylap.frame import Frame
+from easylap.unicast_server import UnicastServer
+from easylap.wire import Encoding
+
+MODES = ('dict', 'frame')
+
+
+def chunks(count):
+  """ The bytes of a stream with at least count frames """
+  stream = SyntheticStream(cars=20, lap=0.5, timer_interval=0.1, duration=None, seed=1)
+  data = []
+  frames = 0
+  for due, chunk in stream:
+    data.append(chunk)
+    frames += chunk.count(0x83) + chunk.count(0x84) # Markers, close enough
+    if frames > count * 1.2:
+      return data
+  return data
+
+
+def build(data, mode, count):
+  """ Returns the history of count packets """
+  decoder = FrameDecoder()
+  history = deque(maxlen=UnicastServer.HISTORY)
+  seq = 0
+  for chunk in data:
+    received_at = time.monotonic()
+    for frame_type, uid, timer_value in decoder.feed(chunk):
+      if mode == 'dict':
+        packet = {Frame.KEY_TIME: timer_value, Frame.KEY_UID: uid}
+      else:
+        packet = Frame(frame_type, uid, timer_value, received_at)
+      seq += 1
+      packet[Frame.KEY_SEQ] = seq
+      history.append(packet)
+      encoded = {}
+      for encoding in Encoding.ALL * 2:
+        datagram = encoded.get(encoding)
+        if datagram is None:
+          datagram = encoded[encoding] = Encoding.encode(packet, encoding, seq)
+      if mode == 'frame': # As send_packet() does once sent
+        packet.json = packet.binary = None
+      if seq == count:
+        return history, seq
+  return history, seq
+
+
+def run(mode, count):
+  data = chunks(count)
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  elapsed = None
+  for i in range(5): # Best of
+    start = time.perf_counter()
+    history, frames = build(data, mode, count)
+    elapsed = min(elapsed or 1e9, time.perf_counter() - start)
+    del history
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+  tracemalloc.start()
+  history, frames = build(data, mode, count)
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return {
+    'mode': mode,
+    'frames': frames,
+    'us_per_frame': elapsed / frames * 1e6,
+    'history_bytes_per_packet': current / len(history),
+    'peak_kb': peak / 1024,
+    'max_rss_kb_growth': rss
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='EasyLap frame benchmark')
+  parser.add_argument('--frames', default=10000, type=int)
+  parser.add_argument('--mode', help='run one mode in this interpreter', choices=MODES, default=None)
+  args = parser.parse_args()
+
+  if args.mode:
+    print(json.dumps(run(args.mode, args.frames)))
+  else:
+    for mode in MODES:
+      output = subprocess.check_output([sys.executable, __file__, '--frames', str(args.frames), '--mode', mode])
+      result = json.loads(output)
+      print('{mode:6} {frames} frames: {us_per_frame:.2f}us per frame, {history_bytes_per_packet:.0f} bytes per packet in the history, '
+        'peak {peak_kb:.0f} kB, max RSS +{max_rss_kb_growth} kB'.format(**result))
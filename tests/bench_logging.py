@@ -0,0 +1,42 @@
+# Per-packet cost of the server hot paths with logging at INFO and at DEBUG.
+# DEBUG output goes to /dev/null, so this measures formatting and handler overhead, not the terminal.
+
+import asyncio
+import logging
+import os
+import sys
+import time
+from easylap import UnicastServer
+
+PACKETS = 20000
+CLIENTS = 12
+
+
+class NullTransport:
+  def sendto(self, data, addr):
+    pass
+
+
+async def measure(server):
+  start = time.perf_counter()
+  for i in range(PACKETS):
+    await server.send_packet({'time': i, 'uid': 1 + i % 20})
+    server.datagram_received(b'HELLO', ('127.0.0.1', 6000 + i % CLIENTS))
+  return (time.perf_counter() - start) / PACKETS * 1e6
+
+
+async def main():
+  server = UnicastServer(port=5905, max_per_host=CLIENTS) # All from loopback
+  server.transport = server.fanout.transport = NullTransport()
+  for i in range(CLIENTS):
+    server.datagram_received(b'HELLO', ('127.0.0.1', 6000 + i))
+  with open(os.devnull, 'w') as devnull:
+    for handler in server.logger.handlers:
+      handler.setStream(devnull)
+    for level in (logging.INFO, logging.DEBUG):
+      server.logger.setLevel(level)
+      print('{}: {:.2f}us per packet'.format(logging.getLevelName(level), await measure(server)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
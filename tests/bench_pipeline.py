@@ -0,0 +1,145 @@
+# End-to-end benchmark of the serial-to-UDP pipeline over loopback:
+# fake cp2110 stream -> AioEasyLapDevice -> CreateService.forward -> UnicastServer -> N UnicastClient
+#
+# Reports frames/second, wire-to-client latency (from the reader thread reading a chunk to a
+# client receiving the packet), CPU time per frame (server and clients, same process), net
+# allocated memory blocks per frame and peak RSS. Python has no allocation counter, so the
+# allocation figure is the growth of sys.getallocatedblocks() and not the number of allocations.
+#
+#   python3 bench_pipeline.py --clients 12 --output before.json
+#   python3 bench_pipeline.py --clients 12 --compare before.json
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import sys
+import time
+
+import easylap.fake.cp2110
+from easylap import AioEasyLapDevice, CreateService, UnicastClient, UnicastServer, backend
+from easylap.fake.cp2110 import CP2110Device as FakeCP2110Device
+from easylap.fake.stream import SyntheticStream
+from easylap.latency import LatencyMeter
+
+PORT = 5905
+CLIENT_PORT = 5910
+
+
+class BenchServer(UnicastServer):
+  """ Remembers when each packet was read from the wire """
+
+  service = None
+  read_at = {}
+
+  async def send_packet(self, packet):
+    await super().send_packet(packet)
+    self.read_at[packet['seq']] = self.service.sending
+
+
+def percentile(values, p):
+  return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+async def run(args):
+  backend.cp2110_module = easylap.fake.cp2110 # Even where the real library is installed
+  stream = SyntheticStream(cars=args.cars, lap=args.lap, noise=args.noise, duration=args.duration, seed=1)
+  expected = sum(1 for frame in stream.frames())
+  FakeCP2110Device.stream = stream
+  FakeCP2110Device.speed = args.speed
+
+  service = CreateService(['--coalesce', str(args.coalesce)], run=False)
+  server = BenchServer(port=PORT, coalesce=args.coalesce / 1000, max_per_host=args.clients) # All from loopback
+  server.service = service
+  await server.create_endpoint()
+
+  latencies = []
+  def received(message):
+    seq = json.loads(message)['seq']
+    latencies.append(time.monotonic() - server.read_at[seq])
+
+  clients = []
+  for i in range(args.clients):
+    client = UnicastClient(port=CLIENT_PORT + i, callback=received)
+    client.ip_addr = '127.0.0.1'
+    await client.create_endpoint()
+    client.transport.sendto(client.hello(), ('127.0.0.1', PORT))
+    clients.append(client)
+  while len(server.clients) < args.clients:
+    await asyncio.sleep(0.01)
+
+  device = AioEasyLapDevice(threaded=not args.poll)
+  blocks = sys.getallocatedblocks()
+  cpu = time.process_time()
+  start = time.perf_counter()
+  latency = LatencyMeter()
+  service.start_sender(server, latency)
+  task = asyncio.ensure_future(service.forward(device, server, latency))
+  last, count = start, 0
+  while time.perf_counter() - last < 1: # Until nothing moves for a second
+    await asyncio.sleep(0.1)
+    if server.seq != count:
+      count, last = server.seq, time.perf_counter()
+  elapsed = last - start
+  cpu = time.process_time() - cpu
+  blocks = sys.getallocatedblocks() - blocks
+  task.cancel()
+  service.sender.cancel()
+  await asyncio.gather(task, service.sender, return_exceptions=True)
+  for client in clients:
+    client.cleanup()
+  await server.close()
+
+  latencies.sort()
+  frames = server.seq
+  return {
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'args': vars(args),
+    'frames_expected': expected,
+    'frames': frames,
+    'dropped': device.dropped,
+    'queues': {queue.name: queue.snapshot() for queue in (device.queue, service.outgoing)},
+    'delivered': len(latencies),
+    'frames_per_second': frames / elapsed if elapsed else None,
+    'latency_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+    'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    'latency_max_ms': latencies[-1] * 1000 if latencies else None,
+    'cpu_us_per_frame': cpu / frames * 1e6 if frames else None,
+    'blocks_per_frame': blocks / frames if frames else None,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  }
+
+
+def compare(result, path):
+  with open(path) as f:
+    before = json.load(f)
+  for key, value in result.items():
+    old = before.get(key)
+    if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+      print('{:20} {:>12.3f} {:>12.3f} {:>+8.1f}%'.format(key, old, value, (value - old) / old * 100))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='EasyLap pipeline benchmark')
+  parser.add_argument('--clients', default=12, type=int)
+  parser.add_argument('--cars', default=20, type=int)
+  parser.add_argument('--lap', help='mean lap time, seconds', default=8.0, type=float)
+  parser.add_argument('--noise', help='garbage bytes per frame', default=0.5, type=float)
+  parser.add_argument('--duration', help='seconds of race traffic', default=600, type=float)
+  parser.add_argument('--speed', help='replay speed, 0 is unthrottled', default=50, type=float)
+  parser.add_argument('--coalesce', help='milliseconds, 0 to send immediately', default=0, type=float)
+  parser.add_argument('--poll', help='poll the device on the event loop', default=False, action='store_true')
+  parser.add_argument('--output', help='save the results as JSON')
+  parser.add_argument('--compare', help='compare with results saved earlier')
+  args = parser.parse_args()
+
+  result = asyncio.run(run(args))
+  print(json.dumps(result, indent=2))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(result, f, indent=2)
+  if args.compare:
+    compare(result, args.compare)
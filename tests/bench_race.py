@@ -0,0 +1,25 @@
+# Feeds a synthetic 50-car stream into the lap computation and reports the cost per crossing.
+
+import random
+import time
+from easylap.race import Race
+
+CARS = 50
+CROSSINGS = 200000
+
+if __name__ == '__main__':
+  random.seed(1)
+  race = Race()
+  timer_value = 0xFFFFFFFF - 100000 # Roll over early in the race
+  packets = []
+  for i in range(CROSSINGS):
+    timer_value = (timer_value + random.randint(50, 200)) & 0xFFFFFFFF
+    packets.append({'time': timer_value, 'uid': random.randint(1, CARS)})
+
+  start = time.perf_counter()
+  for packet in packets:
+    race.update(packet)
+  elapsed = time.perf_counter() - start
+  print('{} crossings, {} cars: {:.2f}us per crossing'.format(CROSSINGS, CARS, elapsed / CROSSINGS * 1e6))
+  for racer in race.positions()[:3]:
+    print('uid={} laps={} best={} average={:.1f}'.format(racer.uid, racer.laps, racer.best_lap, racer.average_lap()))
@@ -0,0 +1,77 @@
+# Startup benchmark: time from starting easylapd to the first device packet received by a
+# client, with the fake cp2110 library, and the time to import the service module.
+#
+#   python3 bench_startup.py --runs 5
+#   python3 bench_startup.py --runs 5 --args=--uvloop
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EASYLAPD = os.path.join(HERE, '..', 'bin', 'easylapd')
+PORT = 5005
+
+
+def environment():
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(HERE, '..', 'src'), env.get('PYTHONPATH')]))
+  env['EASYLAP_FAKE_STREAM'] = 'synthetic:cars=20,lap=0.5,timer_interval=0.1,seed=1'
+  env['EASYLAP_FAKE_SPEED'] = '1'
+  return env
+
+
+def import_time():
+  """ Seconds to import the service module in a new interpreter """
+  code = 'import time; t = time.perf_counter(); import easylap.service; print(time.perf_counter() - t)'
+  return float(subprocess.check_output([sys.executable, '-c', code], env=environment()))
+
+
+def first_packet(args, timeout = 10):
+  """ Seconds from starting easylapd to receiving its first device packet """
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.bind(('127.0.0.1', 0))
+  sock.settimeout(0.005)
+  started = time.perf_counter()
+  process = subprocess.Popen([sys.executable, EASYLAPD] + args, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while time.perf_counter() - started < timeout:
+      sock.sendto(b'HELLO', ('127.0.0.1', PORT))
+      try:
+        data = sock.recv(65536)
+      except (socket.timeout, ConnectionRefusedError):
+        continue
+      if b'"uid"' in data:
+        return time.perf_counter() - started
+    return None
+  finally:
+    process.terminate()
+    try:
+      process.wait(5)
+    except subprocess.TimeoutExpired:
+      process.kill()
+      process.wait()
+    sock.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='easylapd startup benchmark')
+  parser.add_argument('--runs', default=5, type=int)
+  parser.add_argument('--args', help='easylapd arguments', default='')
+  args = parser.parse_args()
+
+  imports = [import_time() for i in range(args.runs)]
+  starts = [first_packet(args.args.split()) for i in range(args.runs)]
+  starts = [start for start in starts if start is not None]
+  print(json.dumps({
+    'runs': args.runs,
+    'import_ms': statistics.median(imports) * 1000,
+    'first_packet_ms': statistics.median(starts) * 1000 if starts else None,
+    'first_packet_max_ms': max(starts) * 1000 if starts else None,
+    'failed': args.runs - len(starts)
+  }, indent=2))
@@ -0,0 +1,38 @@
+# Merges three fake receivers, half a second apart on the track, and prints the sector times.
+
+import asyncio
+
+from easylap.aggregator import DeviceAggregator
+import easylap.fake.cp2110
+from easylap import backend
+from easylap.aiodevice import AioEasyLapDevice
+from easylap.fake.cp2110 import CP2110Device
+from easylap.fake.stream import SyntheticStream
+from easylap.sectors import Sectors
+
+
+async def main():
+  backend.cp2110_module = easylap.fake.cp2110 # Even where the real library is installed
+  CP2110Device.devices = 3
+  CP2110Device.streams = {'FAKE{}'.format(i): SyntheticStream(cars=3, lap=1.5, jitter=0.05, duration=8, timer_interval=0.2, seed=1, offset=0.5 * i, timer_start=1000000 * i) for i in range(3)}
+  devices = [AioEasyLapDevice(connect=False, serial=info['serial']) for info in AioEasyLapDevice.enumerate()]
+  aggregator = DeviceAggregator(devices)
+  sectors = Sectors(aggregator.devices)
+  previous = None
+  async def run():
+    nonlocal previous
+    async for name, packet, when, received_at in aggregator.receive():
+      if previous is not None and when < previous:
+        print('Out of order: {} {}'.format(name, packet))
+      previous = when
+      event = sectors.update(packet, when)
+      if event:
+        print('{uid:5} sector {sector} {from} -> {to}: {time:.3f} s'.format(**event))
+  try:
+    await asyncio.wait_for(run(), 7)
+  except asyncio.TimeoutError:
+    pass
+  print('Late: {}'.format(aggregator.late))
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,93 @@
+# Registers two clients, closes the socket of one of them and prints how long the server
+# keeps sending to it. The closed port answers with ICMP port unreachable.
+#
+# Then registers three plain sockets, closes the first one in fan-out order and checks
+# that the other two still get every packet, with the default max_failures and with 0.
+
+import asyncio
+import socket
+import time
+
+from easylap.clients import ClientRegistry
+from easylap.unicast_client import UnicastClient
+from easylap.unicast_server import UnicastServer
+
+PORT = 5925
+CLIENT_PORT = 5926
+PACKETS = 50
+
+
+async def removed():
+  server = UnicastServer(port=PORT)
+  await server.create_endpoint()
+  received = []
+  clients = []
+  for i in range(2):
+    client = UnicastClient(port=CLIENT_PORT + i, callback=received.append)
+    client.ip_addr = '127.0.0.1'
+    await client.create_endpoint()
+    client.transport.sendto(client.hello(), ('127.0.0.1', PORT))
+    clients.append(client)
+  while len(server.clients) < 2:
+    await asyncio.sleep(0.01)
+
+  gone = clients.pop()
+  gone.cleanup()
+  closed = time.monotonic()
+  seq = 0
+  while len(server.clients) == 2 and time.monotonic() - closed < 5:
+    seq += 1
+    await server.send_packet({'time': seq, 'uid': 0})
+    await asyncio.sleep(0.05)
+  print('Removed after {:.3f} s, {} packets'.format(time.monotonic() - closed, seq))
+  print('Clients left:', list(server.clients), 'failed:', server.clients.failed, 'send errors:', server.fanout.errors)
+  assert len(server.clients) == 1 and server.clients.failed == 1
+
+  for client in clients:
+    client.cleanup()
+  await server.close()
+
+
+async def neighbours(port, max_failures):
+  server = UnicastServer(port=port, max_failures=max_failures)
+  await server.create_endpoint()
+  sockets = []
+  for i in range(3):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', CLIENT_PORT + i))
+    sock.setblocking(False)
+    sock.sendto(b'HELLO', ('127.0.0.1', port))
+    sockets.append(sock)
+    while len(server.clients) <= i: # Registered in this order, the first one is sent to first
+      await asyncio.sleep(0.01)
+
+  sockets.pop(0).close()
+  for seq in range(PACKETS):
+    await server.send_packet({'time': seq, 'uid': 0})
+    await asyncio.sleep(0.01)
+
+  received = []
+  for sock in sockets:
+    count = 0
+    try:
+      while True:
+        sock.recv(2048)
+        count += 1
+    except BlockingIOError:
+      pass
+    received.append(count)
+    sock.close()
+  print('max_failures {}: the others received {} of {} packets, {} clients left, send errors: {}'.format(
+    max_failures, received, PACKETS, len(server.clients), server.fanout.errors))
+  assert received == [PACKETS, PACKETS]
+  await server.close()
+
+
+async def main():
+  await removed()
+  await neighbours(PORT + 10, ClientRegistry.MAX_FAILURES)
+  await neighbours(PORT + 20, 0)
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
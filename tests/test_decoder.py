@@ -0,0 +1,22 @@
+# Decodes the fake cp2110 data, then measures throughput with noise between frames.
+
+import os
+import time
+from easylap import FrameDecoder
+from easylap.fake.cp2110 import CP2110Device
+
+if __name__ == '__main__':
+  decoder = FrameDecoder()
+  for chunk in CP2110Device.fake_data:
+    for frame in decoder.feed(chunk):
+      print(frame)
+
+  car = bytes([0x0D, 0x00, 0x84, 0x01, 0x00, 0x00, 0x00, 0x10, 0x20, 0x30, 0x40, 0x00, 0x00])
+  stream = (os.urandom(64).replace(b'\x0B', b'').replace(b'\x0D', b'') + car) * 20000
+  start = time.perf_counter()
+  count = 0
+  for i in range(0, len(stream), 64):
+    for frame in decoder.feed(stream[i:i + 64]):
+      count += 1
+  elapsed = time.perf_counter() - start
+  print('{} frames, {} bytes in {:.3f}s ({:.0f} bytes/s)'.format(count, len(stream), elapsed, len(stream) / elapsed))
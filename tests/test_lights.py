@@ -0,0 +1,12 @@
+# Sets the lights and counts the I2C transactions on the fake MCP23017.
+
+from easylap.lights import Lights
+from easylap.base import LogOptions
+
+if __name__ == '__main__':
+  lights = Lights(LogOptions())
+  start = lights.mcp.transactions
+  for value in (0x0000, 0x0004, 0x000C, 0x000C, 0x001C, 0xFFFF):
+    lights.set(value).result()
+  lights.close()
+  print('gpio: {:04X}, transactions: {}'.format(lights.mcp._gpio, lights.mcp.transactions - start))
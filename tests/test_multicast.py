@@ -0,0 +1,66 @@
+# Runs a multicast server with three clients: two join the group and one stays on unicast.
+# Prints the datagrams sent per packet before and after the switch, checks that every
+# client received every packet once, then that a client that leaves the group gets
+# unicast again.
+
+import asyncio
+
+from easylap.frame import Frame
+from easylap.unicast_client import UnicastClient
+from easylap.unicast_server import UnicastServer
+
+PORT = 5955
+CLIENT_PORT = 5956
+GROUP = ('239.255.76.1', 5959)
+
+
+async def main():
+  server = UnicastServer(port=PORT, multicast=GROUP)
+  await server.create_endpoint()
+
+  received = [[] for i in range(3)]
+  clients = []
+  for i in range(3):
+    client = UnicastClient(port=CLIENT_PORT + i, callback=received[i].append, multicast=i < 2)
+    client.MULTICAST_TIMEOUT = 1
+    client.ip_addr = server.ip_addr
+    await client.create_endpoint()
+    if client.multicast:
+      await client.join_multicast(*GROUP)
+    client.remote_addr, client.remote_port = server.ip_addr, PORT
+    client.ping_task = asyncio.ensure_future(client.ping(client.transport, server.ip_addr, PORT))
+    clients.append(client)
+  while len(server.clients) < 3:
+    await asyncio.sleep(0.01)
+
+  async def send(count):
+    sent = server.fanout.sent
+    for i in range(count):
+      await server.send_packet(Frame.from_packet({'time': server.seq, 'uid': i % 5}))
+      await asyncio.sleep(0.01)
+    return (server.fanout.sent - sent) / count
+
+  before = await send(10)
+  await asyncio.sleep(1.5) # Clients report multicast at their next check
+  after = await send(50)
+  await asyncio.sleep(0.2)
+
+  print('Datagrams per packet: {} before, {} after ({} clients, multicast to {})'.format(before, after, len(server.clients),
+    sum(1 for client in server.clients.values() if server.receives_multicast(client))))
+  print('Packets received:', [len(messages) for messages in received])
+  assert after == 2 and all(len(messages) == server.seq for messages in received)
+
+  clients[0].multicast_transport.close() # Left the group, e.g. another access point
+  await send(250) # A few seconds of traffic, the gap is resent
+  after = await send(10)
+  await asyncio.sleep(0.2)
+  print('After leaving the group: {} datagrams per packet, packets received: {}'.format(after, [len(messages) for messages in received]))
+  assert after == 3 and all(len(messages) == server.seq for messages in received)
+
+  for client in clients:
+    client.cleanup()
+  await server.close()
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,38 @@
+# Fills the outgoing queue of easylapd past its capacity with a stalled consumer and prints
+# what the overflow policy kept: timer packets are dropped, car packets and events are not.
+
+import asyncio
+
+from easylap.pipeline import BoundedQueue, is_timer_packet
+
+
+async def main():
+  queue = BoundedQueue('outgoing', 8, is_timer_packet)
+  for i in range(20):
+    if i % 3 == 0:
+      queue.put(({'time': i, 'uid': 1000 + i}, 0)) # Car
+    else:
+      queue.put(({'time': i, 'uid': 0}, 0)) # Timer
+  queue.put(({'type': 'lap', 'uid': 0}, None)) # Event
+  print('Queue:', queue.snapshot())
+
+  kept = []
+  while len(queue):
+    packet, received_at = await queue.get()
+    kept.append(packet)
+  cars = [packet for packet in kept if packet['uid']]
+  timers = [packet for packet in kept if not packet['uid'] and 'type' not in packet]
+  events = [packet for packet in kept if 'type' in packet]
+  print('Kept: {} cars, {} timer packets, {} events'.format(len(cars), len(timers), len(events)))
+  assert len(cars) == 7 and len(events) == 1
+  assert kept[-1] is events[0] # In order
+  assert [packet['time'] for packet in kept[:-1]] == sorted(packet['time'] for packet in kept[:-1])
+
+  waiter = asyncio.ensure_future(queue.get())
+  await asyncio.sleep(0.01)
+  queue.put(({'time': 99, 'uid': 1}, 0))
+  print('Woken with:', await asyncio.wait_for(waiter, 1))
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,84 @@
+# Runs 30 cars for a few seconds, about 150 crossings per second, and a spectator that
+# subscribes to the scoreboard. Prints how many datagrams the spectator received against
+# the number of crossings, and checks that the table it rebuilt from keyframes and deltas
+# matches the race.
+
+import asyncio
+import json
+import random
+import time
+
+from easylap.frame import Frame
+from easylap.race import Race
+from easylap.scoreboard import Scoreboard
+from easylap.subscription import Subscription
+from easylap.unicast_client import UnicastClient
+from easylap.unicast_server import UnicastServer
+
+PORT = 5945
+CLIENT_PORT = 5946
+CARS = 30
+SECONDS = 3
+
+
+async def main():
+  random.seed(1)
+  server = UnicastServer(port=PORT)
+  race = Race()
+  scoreboard = Scoreboard(race, server.publish, rate=5, keyframe=1)
+  await server.create_endpoint()
+
+  table = {}
+  version = None
+  datagrams = 0
+  def received(message):
+    nonlocal version, datagrams
+    datagrams += 1
+    packet = json.loads(message)
+    if packet.get('full'):
+      if packet['part'] == 1:
+        table.clear()
+    elif packet['base'] != version and packet['part'] == 1: # Missed one, wait for a keyframe
+      return
+    version = packet['version']
+    for uid in packet.get('removed', []):
+      table.pop(uid, None)
+    for row in packet['rows']:
+      table[row[1]] = row
+
+  client = UnicastClient(port=CLIENT_PORT, callback=received, subscription=Subscription(types=[Scoreboard.TYPE]))
+  client.ip_addr = '127.0.0.1'
+  await client.create_endpoint()
+  client.transport.sendto(client.hello(), ('127.0.0.1', PORT))
+  while not server.clients:
+    await asyncio.sleep(0.01)
+
+  scoreboard.start()
+  timer_value = 0
+  crossings = 0
+  started = time.monotonic()
+  while time.monotonic() - started < SECONDS:
+    timer_value += random.randint(1, 10)
+    frame = Frame.from_packet({'time': timer_value, 'uid': random.randint(1, CARS)})
+    await server.send_packet(frame)
+    event = race.update(frame)
+    if event:
+      await server.send_packet(event)
+    crossings += 1
+    await asyncio.sleep(1 / 150)
+  scoreboard.tick(asyncio.get_running_loop().time())
+  scoreboard.stop()
+  await asyncio.sleep(0.2)
+
+  print('Crossings: {}, scoreboard datagrams: {} ({} deltas, {} keyframes), version {}'.format(
+    crossings, datagrams, scoreboard.deltas, scoreboard.keyframes, version))
+  expected = {uid: row for uid, row in scoreboard.table().items()}
+  print('Leader:', min(table.values()))
+  assert table == expected, (table, expected)
+
+  client.cleanup()
+  await server.close()
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
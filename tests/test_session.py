@@ -0,0 +1,58 @@
+# Sends a few laps of race traffic, then registers a client and prints the snapshot it
+# receives before the next packet.
+
+import asyncio
+import json
+import random
+
+from easylap.frame import Frame
+from easylap.race import Race
+from easylap.session import Session
+from easylap.unicast_client import UnicastClient
+from easylap.unicast_server import UnicastServer
+
+PORT = 5935
+CLIENT_PORT = 5936
+CARS = 60
+
+
+async def main():
+  random.seed(1)
+  server = UnicastServer(port=PORT)
+  server.session = Session()
+  race = Race()
+  await server.create_endpoint()
+
+  timer_value = 0
+  for i in range(CARS * 5):
+    timer_value += random.randint(50, 200)
+    frame = Frame.from_packet({'time': timer_value, 'uid': 1 + i % CARS})
+    await server.send_packet(frame)
+    event = race.update(frame)
+    if event:
+      await server.send_packet(event)
+
+  received = []
+  client = UnicastClient(port=CLIENT_PORT, callback=lambda message: received.append(json.loads(message)))
+  client.ip_addr = '127.0.0.1'
+  await client.create_endpoint()
+  client.transport.sendto(client.hello(), ('127.0.0.1', PORT))
+  while not server.clients:
+    await asyncio.sleep(0.01)
+  await server.send_packet(Frame.from_packet({'time': timer_value + 100, 'uid': 0}))
+  await asyncio.sleep(0.2)
+
+  snapshots = [message for message in received if message.get('type') == Session.TYPE]
+  cars = [car for snapshot in snapshots for car in snapshot['cars']]
+  print('Datagrams: {}, sizes: {}'.format(len(snapshots), [len(json.dumps(snapshot)) for snapshot in snapshots]))
+  print('First cars:', cars[:3])
+  print('Then:', received[len(snapshots):])
+  assert len(cars) == CARS and received[0]['last_seq'] == server.seq - 1
+  assert all(laps == race.racers[uid].laps for uid, last, crossings, laps in cars)
+
+  client.cleanup()
+  await server.close()
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
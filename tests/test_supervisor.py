@@ -0,0 +1,42 @@
+# Unplugs and plugs the fake device and prints how long the supervisor takes to reconnect.
+
+import asyncio
+import time
+
+import easylap.fake.cp2110
+from easylap import backend
+from easylap.aiodevice import AioEasyLapDevice
+from easylap.fake.cp2110 import CP2110Device
+from easylap.fake.stream import SyntheticStream
+from easylap.supervisor import DeviceSupervisor
+
+
+async def main():
+  backend.cp2110_module = easylap.fake.cp2110 # Even where the real library is installed
+  CP2110Device.stream = SyntheticStream(cars=5, lap=1.0, duration=60, seed=1)
+  CP2110Device.present = False
+  states = []
+  frames = []
+  supervisor = DeviceSupervisor(AioEasyLapDevice(connect=False), lambda state: states.append(time.monotonic()))
+
+  async def reader(easylap):
+    async for packet in easylap.receive():
+      frames.append(packet)
+
+  task = asyncio.ensure_future(supervisor.run(reader))
+  for absent in (1.0, 0.3):
+    await asyncio.sleep(absent)
+    plugged = time.monotonic()
+    count = len(states)
+    CP2110Device.present = True
+    while len(states) == count:
+      await asyncio.sleep(0.001)
+    print('Connected after {:.3f} s'.format(states[-1] - plugged))
+    await asyncio.sleep(1.5)
+    CP2110Device.present = False
+  task.cancel()
+  await asyncio.gather(task, return_exceptions=True)
+  print('Frames: {}, connects: {}, failures: {}'.format(len(frames), supervisor.connects, supervisor.failures))
+
+if __name__ == '__main__':
+  asyncio.run(main())